@@ -1,6 +1,24 @@
+import time
+import urllib
+
 import api
+import cache
 import constants
 import m3u8
+import poller
+import selection
+import throughput
+import workers
+
+landing_cache = cache.TTLCache(constants.LANDING_CACHE_TTL)
+manifest_pool = workers.Pool(constants.MANIFEST_WORKERS)
+play_cache = cache.TTLCache(constants.STREAM_CACHE_TTL)
+stream_url_cache = cache.TTLCache(constants.STREAM_CACHE_TTL)
+master_cache = cache.TTLCache(constants.STREAM_CACHE_TTL)
+asset_registry = cache.TTLCache(constants.ASSET_REGISTRY_TTL)
+shared_playlists = cache.TTLCache(constants.SHARED_PLAYLIST_TTL)
+prefetch_pool = workers.Pool(constants.PREFETCH_WORKERS)
+prefetch_limiter = workers.RateLimiter(constants.PREFETCH_RATE)
 
 
 def Start():
@@ -16,34 +34,104 @@ def MainMenu():
     username = Prefs['kayo_username']
     password = Prefs['kayo_password']
     if username and password:
-        login_result = api.login(username, password)
-        if 'access_token' in login_result:
-            json_login = JSON.ObjectFromString(login_result)
-            access_token = json_login['access_token']
-            profiles_result = api.list_profiles(access_token)
+        profiles_result = api.with_access_token(username, password, api.list_profiles)
+        if profiles_result:
             profiles_json = JSON.ObjectFromString(profiles_result)
             for profile in profiles_json:
                 oc.add(DirectoryObject(
-                    key=Callback(get_top_events, access_token=access_token, profile_id=profile['id'],
-                                 profile_name=profile['name']),
+                    key=Callback(get_top_events, profile_id=profile['id'], profile_name=profile['name']),
                     title=profile['name']
                 ))
-    else:
-        Log("Login Failed...")
+        else:
+            Log("Login Failed...")
 
     return oc
 
 
-def get_top_events(access_token, profile_id, profile_name):
+def ValidatePrefs():
+    # Credentials may have changed, make the next menu load log in again
+    api.clear_token()
+    invalidate_landing()
+    play_cache.invalidate()
+    stream_url_cache.invalidate()
+    master_cache.invalidate()
+
+
+def authorized(call, *args):
+    '''
+    Returns call(access_token, *args) with a current access token. Handlers get the
+    token when they run, callbacks replayed later would otherwise carry a stale one.
+    '''
+    result = api.with_access_token(Prefs['kayo_username'], Prefs['kayo_password'], call, *args)
+    if result is None:
+        Log("Login Failed...")
+        raise Ex.MediaNotAvailable
+    return result
+
+
+def int_pref(name, default):
+    try:
+        return int(Prefs[name])
+    except (TypeError, ValueError):
+        return default
+
+
+def float_pref(name, default):
+    try:
+        return float(Prefs[name])
+    except (TypeError, ValueError):
+        return default
+
+
+def get_landing(access_token, profile_id):
+    '''
+    Returns the parsed sports landing page for a profile, shared by the menus
+    for `kayo_cache_ttl` seconds so navigating deeper doesn't fetch it again
+    '''
+    def load():
+        landing = JSON.ObjectFromString(api.get_live_events(access_token, profile_id))
+        register_assets(landing)
+        return landing
+
+    ttl = int_pref('kayo_cache_ttl', constants.LANDING_CACHE_TTL)
+    return landing_cache.get_or_load(profile_id, load, ttl=ttl)
+
+
+def invalidate_landing(profile_id=None):
+    landing_cache.invalidate(profile_id)
+
+
+def register_assets(landing):
+    for section in landing:
+        for item in section.get('contents', []):
+            asset = item.get('data', {}).get('asset')
+            if asset and 'id' in asset:
+                asset_registry.set(asset['id'], asset)
+
+
+def get_asset(access_token, profile_id, asset_id):
+    '''
+    Looks up an asset listed on the landing page by id, fetching the landing
+    page again if it has dropped out of the registry
+    '''
+    asset = asset_registry.get(asset_id)
+    if asset is None:
+        invalidate_landing(profile_id)
+        get_landing(access_token, profile_id)
+        asset = asset_registry.get(asset_id)
+        if asset is None:
+            raise Ex.MediaNotAvailable
+    return asset
+
+
+def get_top_events(profile_id, profile_name):
     oc = ObjectContainer(title2=profile_name)
-    request = api.get_live_events(access_token, profile_id)
-    request_json = JSON.ObjectFromString(request)
+    request_json = authorized(get_landing, profile_id)
     live_sport = request_json[1]
     if 'contents' in live_sport:
         Log("Live Sport available")
         oc.add(DirectoryObject(
-            key=Callback(get_events, access_token=access_token, profile_id=profile_id,
-                         profile_name=profile_name, show_type=1),
+            key=Callback(get_events, profile_id=profile_id, profile_name=profile_name, show_type=1),
             title="Live Sport"
         ))
     else:
@@ -52,76 +140,51 @@ def get_top_events(access_token, profile_id, profile_name):
     return oc
 
 
-def get_events(access_token, profile_id, profile_name, show_type=1):
+def get_events(profile_id, profile_name, show_type=1):
     if show_type == 1:
         string = "Live Sport"
     oc = ObjectContainer(title2=string)
-    request = api.get_live_events(access_token, profile_id)
-    request_json = JSON.ObjectFromString(request)
+    request_json = authorized(get_landing, profile_id)
     result = request_json[show_type]
     if 'contents' in result:
         Log(string + " available")
         for sport in result['contents']:
-            Log("IMAGE URL: " + sport['data']['asset']['images']['defaultUrl'])
+            asset = sport['data']['asset']
+            Log("IMAGE URL: " + asset['images']['defaultUrl'])
             oc.add(VideoClipObject(
-                key=Callback(get_stream, access_token=access_token, sport=sport, container=True),
-                rating_key=sport['data']['asset']['id'],
-                title=sport['data']['asset']['title'],
-                summary=sport['data']['asset']['description'],
-                thumb=sport['data']['asset']['images']['defaultUrl']
+                key=Callback(get_stream, profile_id=profile_id, asset_id=asset['id'], container=True),
+                rating_key=asset['id'],
+                title=asset['title'],
+                summary=asset['description'],
+                thumb=asset['images']['defaultUrl']
             ))
+        prefetch_count = max(0, int_pref('kayo_prefetch_count', 0))
+        for sport in result['contents'][:prefetch_count]:
+            prefetch_pool.submit(prefetch_stream, sport['data']['asset']['id'])
     else:
         Log("No " + string + " currently")
 
     return oc
 
 
-def get_stream(access_token, sport, container=False, **kwargs):
-    stream_id = sport['data']['asset']['id']
-    stream_name = sport['data']['asset']['title']
-    thumbnail = sport['data']['asset']['images']['defaultUrl']
-
-    request = api.get_stream(access_token, stream_id)
-    request_json = JSON.ObjectFromString(request)
-    stream_url = request_json['data'][0]['recommendedStream']['manifest']['uri']
-    streams = m3u8.load(stream_url)
-    alernative_stream_url = request_json['data'][0]['alternativeStreams'][0]['manifest']['uri']
-    streams_alternative = m3u8.load(alernative_stream_url)
-    bandwidth = Prefs['kayo_bandwidth']
-    current_stream = None
-
-    for stream in streams.playlists:
-        Log("Stream:")
-        Log(str(stream.stream_info))
-        Log(str(stream.uri))
-        Log(str(stream.base_uri))
-        stream_bandwidth = stream.stream_info.bandwidth
-        if int(stream_bandwidth) <= int(bandwidth) and \
-                (current_stream is None or int(current_stream.stream_info.bandwidth) < int(stream_bandwidth)):
-            current_stream = stream
-
-    for stream in streams_alternative.playlists:
-        Log("Alternative Stream:")
-        Log(str(stream.stream_info))
-        Log(str(stream.uri))
-        Log(str(stream.base_uri))
-        stream_bandwidth = stream.stream_info.bandwidth
-        if int(stream_bandwidth) <= int(bandwidth) and \
-                (current_stream is None or int(current_stream.stream_info.bandwidth) < int(stream_bandwidth)):
-            current_stream = stream
-
-    stream_url = current_stream.base_uri + current_stream.uri
+def get_stream(profile_id, asset_id, container=False, **kwargs):
+    asset = authorized(get_asset, profile_id, asset_id)
+    stream_id = asset['id']
+    stream_name = asset['title']
+    thumbnail = asset['images']['defaultUrl']
+
+    # Only metadata here, the stream is resolved by play_stream once playback starts
     vco = VideoClipObject(
-        key=Callback(get_stream, access_token=access_token, sport=sport, container=True),
-        url=stream_url,
+        key=Callback(get_stream, profile_id=profile_id, asset_id=asset_id, container=True),
+        rating_key=stream_id,
         title=stream_name,
-        summary=sport['data']['asset']['description'],
+        summary=asset['description'],
         thumb=thumbnail,
         items=[
             MediaObject(
                 parts=[
                     PartObject(
-                        key=get_video_url(url=stream_url)
+                        key=get_video_url(url=Callback(play_stream, stream_id=stream_id))
                     )
                 ],
                 optimized_for_streaming=False
@@ -130,13 +193,318 @@ def get_stream(access_token, sport, container=False, **kwargs):
     )
 
     if container:
-        Log("Loading Video with container: " + stream_url)
+        Log("Loading Video with container: " + stream_id)
         return ObjectContainer(objects=[vco])
     else:
-        Log("Loading Video: " + stream_url)
+        Log("Loading Video: " + stream_id)
         return vco
 
 
+@indirect
+def play_stream(stream_id, **kwargs):
+    if Prefs['kayo_master_playlist']:
+        Log("Playing Video through its master playlist: " + stream_id)
+        return IndirectResponse(VideoClipObject, key=get_video_url(
+            url=Callback(master_playlist, stream_id=stream_id, ext='m3u8')))
+    stream_url = authorized(resolve_stream, stream_id)
+    Log("Playing Video: " + stream_url)
+    return IndirectResponse(VideoClipObject, key=get_video_url(url=playlist_link(stream_url)))
+
+
+@route(constants.PREFIX + '/master')
+def master_playlist(stream_id, **kwargs):
+    '''
+    Serves a master playlist with every variant the preferences allow from all
+    CDNs, so clients switch between bitrates and CDNs on their own
+    '''
+    return DataObject(authorized(resolve_master, stream_id), constants.HLS_CONTENT_TYPE)
+
+
+@route(constants.PREFIX + '/media')
+def media_playlist(url, **kwargs):
+    '''
+    Serves the copy of a live media playlist shared by every player watching it
+    '''
+    if shared_playlists.get(url) is None:
+        raise Ex.MediaNotAvailable
+    # Keep serving it for as long as players are watching
+    shared_playlists.set(url, True)
+    return DataObject(poller.get_playlist(url), constants.HLS_CONTENT_TYPE)
+
+
+def playlist_link(url):
+    '''
+    Returns the url players should load a media playlist from: the shared copy
+    served by `media_playlist` when `kayo_share_playlists` is on
+    '''
+    if not Prefs['kayo_share_playlists']:
+        return url
+    # Only playlists handed out here are served, the route is no open proxy
+    shared_playlists.set(url, True)
+    return Callback(media_playlist, url=url, ext='m3u8')
+
+
+def prefetch_stream(stream_id):
+    '''
+    Warms the stream caches for an event while its listing is on screen,
+    rate limited across all prefetches to keep API usage polite
+    '''
+    resolve, resolved = resolve_stream, stream_url_cache
+    if Prefs['kayo_master_playlist']:
+        resolve, resolved = resolve_master, master_cache
+    if resolved.get(stream_cache_key(stream_id)) is not None:
+        return
+    prefetch_limiter.acquire()
+    try:
+        authorized(resolve, stream_id)
+    except Exception as e:
+        Log("Prefetch failed for " + stream_id + ": " + str(e))
+
+
+def stream_cache_key(stream_id):
+    return (stream_id, Prefs['kayo_bandwidth'], Prefs['kayo_bandwidth_mode'], Prefs['kayo_max_resolution'],
+            Prefs['kayo_codecs'], Prefs['kayo_max_frame_rate'], Prefs['kayo_share_playlists'])
+
+
+def resolve_stream(access_token, stream_id):
+    '''
+    Returns the url of the best variant under the bandwidth and format preferences.
+    The result is cached per asset and preferences until the signed manifest urls expire
+    '''
+    cache_key = stream_cache_key(stream_id)
+    stream_url = stream_url_cache.get(cache_key)
+    if stream_url is not None:
+        return stream_url
+
+    urls, manifests, variants = get_variants(access_token, stream_id)
+    stream, _ = select_variant(bandwidth_groups(variants), format_constraints())
+    Log("Selected stream out of " + str(len(variants)) + ": " + str(stream.stream_info))
+    stream_url = variant_url(stream)
+    ttl = stream_cache_ttl(urls + [stream_url])
+    if ttl > 0:
+        stream_url_cache.set(cache_key, stream_url, ttl=ttl)
+    return stream_url
+
+
+def resolve_master(access_token, stream_id):
+    '''
+    Returns the master playlist served by `master_playlist`, cached like resolve_stream
+    '''
+    cache_key = stream_cache_key(stream_id)
+    content = master_cache.get(cache_key)
+    if content is not None:
+        return content
+
+    urls, manifests, variants = get_variants(access_token, stream_id)
+    playable = playable_variants(bandwidth_groups(variants))
+    Log("Serving " + str(len(playable)) + " out of " + str(len(variants)) + " streams")
+    content = build_master(manifests, playable).dumps()
+    ttl = stream_cache_ttl(urls + [variant_url(variant) for variant in playable])
+    if Prefs['kayo_share_playlists']:
+        # The shared playlist links in it must still be served when it is handed out
+        ttl = min(ttl, constants.SHARED_PLAYLIST_TTL - constants.STREAM_EXPIRY_MARGIN)
+    if ttl > 0:
+        master_cache.set(cache_key, content, ttl=ttl)
+    return content
+
+
+def get_variants(access_token, stream_id):
+    '''
+    Returns the manifest urls of an asset, the master playlists that loaded and
+    a VariantIndex of their variants
+    '''
+    play_data = get_play_data(access_token, stream_id)
+    urls = manifest_urls(play_data)
+    manifests = load_manifests(urls)
+    variants = selection.VariantIndex(manifests)
+    if not variants:
+        raise Ex.MediaNotAvailable
+    return urls, manifests, variants
+
+
+def format_constraints():
+    return dict(max_resolution=selection.parse_resolution(Prefs['kayo_max_resolution']),
+                codecs=selection.parse_codecs(Prefs['kayo_codecs']),
+                max_frame_rate=float_pref('kayo_max_frame_rate', None))
+
+
+def select_variant(groups, constraints):
+    '''
+    Picks the variant to play from the groups of `bandwidth_groups`, ignoring the
+    format constraints when no variant meets them. Returns the variant and the
+    constraints it was picked with
+    '''
+    stream = select_within(groups, constraints)
+    if stream is None:
+        Log("No stream matches the format preferences, ignoring them")
+        constraints = {}
+        stream = select_within(groups, constraints)
+    return stream, constraints
+
+
+def playable_variants(groups):
+    '''
+    Returns every variant within the caps of the groups that meets the format
+    preferences, starting with the one select_variant picks so clients start there
+    '''
+    first, constraints = select_variant(groups, format_constraints())
+    others = []
+    for cap, hosted in groups:
+        # Highest bandwidth first, sorted is stable so ties keep the recommended variant first
+        variants = sorted(hosted.within(cap, **constraints),
+                          key=lambda variant: -int(variant.stream_info.bandwidth))
+        others.extend(variant for variant in variants if variant is not first)
+    return [first] + others
+
+
+def bandwidth_groups(variants):
+    '''
+    Returns (cap, VariantIndex) pairs to select from: one per CDN host in measured
+    mode, else all variants under the bandwidth preference
+    '''
+    if Prefs['kayo_bandwidth_mode'] == 'Measured':
+        groups = measured_groups(variants)
+        if groups:
+            return groups
+        Log("Throughput could not be measured, using the bandwidth preference")
+    return [(int_pref('kayo_bandwidth', None), variants)]
+
+
+def measured_groups(variants):
+    '''
+    Splits the variants by CDN host, each paired with the bandwidth cap its measured
+    throughput allows. Hosts without a recent estimate are probed in parallel for up
+    to PROBE_TIMEOUT seconds, those that can't be measured in time are left out
+    '''
+    hosts = variants.group_by(lambda variant: throughput.host_of(variant_url(variant)))
+    deadline = time.time() + constants.PROBE_TIMEOUT
+    probes = []
+    for host, hosted in hosts.items():
+        if throughput.estimate(host) is None:
+            urls = [variant_url(variant) for variant in reversed(hosted.variants[-constants.PROBE_VARIANTS:])]
+            probes.append(manifest_pool.submit(throughput.probe, host, urls, deadline))
+    # Probes still running carry on in the background, their estimates serve later plays
+    workers.wait_all(probes, constants.PROBE_TIMEOUT)
+
+    groups = []
+    for host, hosted in hosts.items():
+        bandwidth = throughput.estimate(host)
+        if bandwidth is not None:
+            cap = int(bandwidth * constants.THROUGHPUT_HEADROOM)
+            Log("Throughput to " + host + " is " + str(int(bandwidth)) + " bps, capping at " + str(cap))
+            groups.append((cap, hosted))
+    return groups
+
+
+def variant_url(variant):
+    return m3u8.urijoin(variant.base_uri, variant.uri)
+
+
+def select_within(groups, constraints):
+    '''
+    Selects from each (cap, VariantIndex) group and returns the highest bandwidth
+    pick, preferring picks that fit under their cap
+    '''
+    best = None
+    best_rank = None
+    for cap, hosted in groups:
+        stream = hosted.select(max_bandwidth=cap, **constraints)
+        if stream is not None:
+            bandwidth = int(stream.stream_info.bandwidth)
+            rank = (cap is None or bandwidth <= cap, bandwidth)
+            if best is None or rank > best_rank:
+                best, best_rank = stream, rank
+    return best
+
+
+def build_master(manifests, variants):
+    '''
+    Builds a master playlist of `variants` with absolute uris, see `playlist_link`.
+    Rendition groups are renamed per manifest, as groups of the same name on
+    different CDNs needn't match
+    '''
+    numbers = dict((id(variant), number) for number, manifest in enumerate(manifests)
+                   for variant in manifest.playlists)
+    master = m3u8.M3U8()
+    used = set()
+    for variant in variants:
+        number = numbers[id(variant)]
+        groups = {}
+        for media_type in ('audio', 'video', 'subtitles', 'closed_captions'):
+            group_id = getattr(variant.stream_info, media_type)
+            # CLOSED-CAPTIONS=NONE names no group
+            if group_id and group_id != 'NONE':
+                groups[media_type] = rendition_group(number, group_id)
+        used.update(groups.values())
+        stream_info = variant.stream_info._replace(**groups)
+        master.add_playlist(m3u8.Playlist(playlist_link(variant_url(variant)), stream_info, [], None))
+
+    for number, manifest in enumerate(manifests):
+        for attributes in manifest.media:
+            group_id = rendition_group(number, attributes.get('group_id'))
+            if group_id in used:
+                media = dict(attributes, group_id=group_id)
+                if media.get('uri'):
+                    media['uri'] = playlist_link(m3u8.urijoin(manifest.playlists[0].base_uri, media['uri']))
+                master.add_media(m3u8.Media(**media))
+
+    # Segments of every variant must start independently for the tag to hold
+    sources = set(numbers[id(variant)] for variant in variants)
+    master.is_independent_segments = all(manifests[number].is_independent_segments for number in sources)
+    return master
+
+
+def rendition_group(number, group_id):
+    return 'cdn%d-%s' % (number, group_id) if group_id else None
+
+
+def get_play_data(access_token, stream_id):
+    play_data = play_cache.get(stream_id)
+    if play_data is None:
+        request = api.get_stream(access_token, stream_id)
+        play_data = JSON.ObjectFromString(request)['data'][0]
+        ttl = stream_cache_ttl(manifest_urls(play_data))
+        if ttl > 0:
+            play_cache.set(stream_id, play_data, ttl=ttl)
+    return play_data
+
+
+def manifest_urls(play_data):
+    urls = [play_data['recommendedStream']['manifest']['uri']]
+    if play_data.get('alternativeStreams'):
+        urls.append(play_data['alternativeStreams'][0]['manifest']['uri'])
+    return urls
+
+
+def stream_cache_ttl(urls):
+    '''
+    Returns how many seconds stream data signed with these urls can be reused: until
+    shortly before the earliest token expiry, or `kayo_stream_cache_ttl` when none of
+    the urls carries an expiry
+    '''
+    expiries = [int(match) for url in urls
+                for match in constants.TOKEN_EXPIRY_PATTERN.findall(urllib.unquote(url))]
+    if not expiries:
+        return int_pref('kayo_stream_cache_ttl', constants.STREAM_CACHE_TTL)
+    return int(min(expiries) - time.time() - constants.STREAM_EXPIRY_MARGIN)
+
+
+def load_manifests(urls):
+    '''
+    Fetches the master playlists in parallel and returns the ones that loaded
+    within MANIFEST_TIMEOUT, so a slow or failing CDN doesn't hold up playback
+    '''
+    tasks = [manifest_pool.submit(m3u8.load_variants, url, timeout=constants.MANIFEST_TIMEOUT) for url in urls]
+    workers.wait_all(tasks, constants.MANIFEST_TIMEOUT)
+    manifests = []
+    for url, task in zip(urls, tasks):
+        try:
+            manifests.append(task.result(0))
+        except Exception as e:
+            Log("Manifest unavailable " + url + ": " + str(e))
+    return manifests
+
+
 def get_video_url(url, live=True):
     return HTTPLiveStreamURL(url=url)
 
@@ -1,4 +1,7 @@
+import time
+
 import constants
+import transport
 
 
 def login(username, password):
@@ -12,21 +15,104 @@ def login(username, password):
         'username': username,
         'password': password
     }
-    request = HTTP.Request(constants.AUTH_URL, headers=headers, data=JSON.StringFromObject(body))
+    request = transport.request(constants.AUTH_URL, headers=headers, data=JSON.StringFromObject(body))
+    return request.content
+
+
+def refresh_login(refresh_token):
+    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+    body = {
+        'grant_type': "refresh_token",
+        'client_id': constants.CLIENT_ID,
+        'refresh_token': refresh_token
+    }
+    request = transport.request(constants.AUTH_URL, headers=headers, data=JSON.StringFromObject(body))
     return request.content
 
 
+def get_access_token(username, password):
+    '''
+    Returns an access token for the given account, or None if the login fails.
+    The token is kept in plugin storage and reused until shortly before it expires,
+    it is then renewed with the refresh token and only falls back to a full login
+    when there is no usable refresh token.
+    '''
+    token = Dict[constants.TOKEN_KEY]
+    if token and token.get('username') == username:
+        if time.time() < token['expires_at'] - constants.TOKEN_EXPIRY_MARGIN:
+            return token['access_token']
+        if token.get('refresh_token'):
+            try:
+                refresh_result = JSON.ObjectFromString(refresh_login(token['refresh_token']))
+            except Exception as e:
+                Log("Token refresh failed: " + str(e))
+                refresh_result = {}
+            if 'access_token' in refresh_result:
+                return store_token(username, refresh_result, token['refresh_token'])
+
+    try:
+        login_result = JSON.ObjectFromString(login(username, password))
+    except Exception as e:
+        Log("Login failed: " + str(e))
+        login_result = {}
+    if 'access_token' in login_result:
+        return store_token(username, login_result)
+
+    clear_token()
+    return None
+
+
+def with_access_token(username, password, call, *args):
+    '''
+    Returns call(access_token, *args) with an access token for the given account, or
+    None if the login fails. A stored token the server rejects before it expires,
+    revoked or issued before a password change, is dropped and the call made once
+    more after logging in again.
+    '''
+    access_token = get_access_token(username, password)
+    if not access_token:
+        return None
+    try:
+        return call(access_token, *args)
+    except transport.HTTPError as e:
+        if e.status != 401:
+            raise
+        Log("Access token rejected, logging in again")
+    clear_token()
+    access_token = get_access_token(username, password)
+    if not access_token:
+        return None
+    return call(access_token, *args)
+
+
+def store_token(username, result, refresh_token=None):
+    Dict[constants.TOKEN_KEY] = {
+        'username': username,
+        'access_token': result['access_token'],
+        'refresh_token': result.get('refresh_token', refresh_token),
+        'expires_at': time.time() + int(result.get('expires_in', 0))
+    }
+    Dict.Save()
+    return result['access_token']
+
+
+def clear_token():
+    if Dict[constants.TOKEN_KEY]:
+        Dict[constants.TOKEN_KEY] = None
+        Dict.Save()
+
+
 def list_profiles(access_token):
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
     headers.update({"Authorization": "Bearer " + access_token})
-    request = HTTP.Request(constants.PROFILES_URL, headers=headers)
+    request = transport.request(constants.PROFILES_URL, headers=headers)
     return request.content
 
 
 def get_live_events(access_token, profile_id):
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
     headers.update({"Authorization": "Bearer " + access_token})
-    request = HTTP.Request(constants.LIVE_EVENTS_URL.replace('${profileId}', profile_id), headers=headers)
+    request = transport.request(constants.LIVE_EVENTS_URL.replace('${profileId}', profile_id), headers=headers)
     return request.content
 
 
@@ -34,7 +120,7 @@ def get_stream(access_token, stream_id):
     headers = {"Content-Type": "application/json", "Accept": "application/json", "Origin": "kayosports.com.au",
                "Authorization": "Bearer " + access_token}
     body = {}
-    request = HTTP.Request(constants.STREAM_URL.replace('${streamId}', stream_id), headers=headers,
-                           data=JSON.StringFromObject(body))
+    request = transport.request(constants.STREAM_URL.replace('${streamId}', stream_id), headers=headers,
+                                data=JSON.StringFromObject(body))
     return request.content
 
@@ -0,0 +1,67 @@
+import threading
+import time
+
+# Expired entries are only swept once the cache grows past this size
+PRUNE_THRESHOLD = 64
+
+_missing = object()
+
+
+class TTLCache(object):
+    '''
+    Thread safe dictionary whose entries expire a number of seconds after being stored.
+
+    `ttl`
+      default lifetime in seconds, can be overridden for each entry on `set`
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if time.time() >= expires:
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        with self._lock:
+            if len(self._entries) >= PRUNE_THRESHOLD:
+                self._prune(now)
+            self._entries[key] = (value, now + ttl)
+
+    def get_or_load(self, key, loader, ttl=None):
+        '''
+        Returns the cached value for `key`, calling `loader()` and caching
+        its result when there is none
+        '''
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key=None):
+        '''
+        Drops the entry for `key`, or every entry when no key is given
+        '''
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _prune(self, now):
+        for key, (_, expires) in self._entries.items():
+            if now >= expires:
+                del self._entries[key]
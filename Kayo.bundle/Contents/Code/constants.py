@@ -1,9 +1,53 @@
+import re
+
 PREFIX = "/video/kayosports"
 ART = "logo.png"
 ICON = "art-default.png"
 NAME = "Kayo Sports"
+HLS_CONTENT_TYPE = "application/vnd.apple.mpegurl"
 AUTH_URL = "https://auth.kayosports.com.au/oauth/token"
 PROFILES_URL = "https://profileapi.kayosports.com.au/user/profile"
 LIVE_EVENTS_URL = "https://vccapi.kayosports.com.au/v2/content/types/landing/names/sports?evaluate=3&profile=${profileId}"
 STREAM_URL = "https://vmndplay.kayosports.com.au/api/v1/asset/${streamId}/play.json?fields=alternativeStreams"
 CLIENT_ID = "qjmv9ZvaMDS9jGvHOxVfImLgQ3G5NrT2"
+TOKEN_KEY = "kayo_token"
+# Seconds before expiry at which a stored access token is renewed
+TOKEN_EXPIRY_MARGIN = 300
+# Seconds the sports landing page is reused between menus
+LANDING_CACHE_TTL = 60
+# Master playlists are fetched in parallel, each one gets this many seconds
+MANIFEST_WORKERS = 4
+MANIFEST_TIMEOUT = 10
+# Play responses and resolved variant urls are reused until their signed urls expire,
+# or for STREAM_CACHE_TTL seconds when no expiry can be found in them
+STREAM_CACHE_TTL = 300
+STREAM_EXPIRY_MARGIN = 60
+# Matched against unquoted urls, = covers tokens such as hdnts=exp=...~acl=...
+TOKEN_EXPIRY_PATTERN = re.compile(r'(?:^|[?&~;/=])(?:exp|expires|Expires)=(\d{10})')
+# Assets seen on the landing page can be looked up by id for this long
+ASSET_REGISTRY_TTL = 6 * 60 * 60
+# Background prefetching of listed events: concurrent resolutions and resolutions per second
+PREFETCH_WORKERS = 2
+PREFETCH_RATE = 1.0
+# Measured bandwidth mode: throughput estimates are kept per CDN host in Dict, each new
+# sample weighted by THROUGHPUT_WEIGHT, and trusted without probing for THROUGHPUT_MAX_AGE seconds
+THROUGHPUT_KEY = "kayo_throughput"
+THROUGHPUT_WEIGHT = 0.3
+THROUGHPUT_MAX_AGE = 30 * 60
+# Share of the estimate a variant may use, the rest is headroom against rebuffering
+THROUGHPUT_HEADROOM = 0.8
+# Hosts are probed in parallel, each timing the first PROBE_SEGMENTS segments of its PROBE_VARIANTS
+# highest variants and reading at most PROBE_MAX_BYTES, all within PROBE_TIMEOUT seconds
+PROBE_VARIANTS = 2
+PROBE_SEGMENTS = 2
+PROBE_MAX_BYTES = 2 * 1024 * 1024
+PROBE_TIMEOUT = 4
+# Shared live playlists: each one is refreshed every target duration, or half of it when the
+# last refresh brought nothing new (POLL_INTERVAL without a target duration), and no longer
+# polled once no player has asked for it in POLL_IDLE_TIMEOUT seconds
+POLL_INTERVAL = 6
+POLL_TIMEOUT = 10
+POLL_IDLE_TIMEOUT = 60
+# Links to shared playlists are served for this long after they were handed out or last
+# loaded, cached master playlists holding them are dropped STREAM_EXPIRY_MARGIN earlier
+SHARED_PLAYLIST_TTL = STREAM_CACHE_TTL
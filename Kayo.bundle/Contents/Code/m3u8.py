@@ -1,3 +1,5 @@
+import array
+import bisect
 import datetime
 import errno
 import itertools
@@ -5,13 +7,12 @@ import math
 import os
 import posixpath
 import re
-import ssl
-import sys
 from collections import namedtuple
-from datetime import date, datetime
-from urllib2 import urlopen, Request
+from datetime import date, datetime, timedelta, tzinfo
 from urlparse import urlparse, urljoin
 
+import transport
+
 ext_x_targetduration = '#EXT-X-TARGETDURATION'
 ext_x_media_sequence = '#EXT-X-MEDIA-SEQUENCE'
 ext_x_discontinuity_sequence = '#EXT-X-DISCONTINUITY-SEQUENCE'
@@ -38,10 +39,96 @@ ext_x_cue_span = '#EXT-X-CUE-SPAN'
 ext_x_map = '#EXT-X-MAP'
 ext_x_start = '#EXT-X-START'
 
-ATTRIBUTELISTPATTERN = re.compile(r'''((?:[^,"']|"[^"]*"|'[^']*')+)''')
+READ_CHUNK_SIZE = 64 * 1024
+
+# NAME=value pairs of an attribute list, values may be quoted and contain commas
+ATTRIBUTE_PATTERN = re.compile(r'''([^=,]*)=((?:[^,"']|"[^"]*"|'[^']*')*)''')
+# RFC 3339 date-time, as used by EXT-X-PROGRAM-DATE-TIME
+RFC3339_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?'
+                             r'(?:[Zz]|([+-])(\d{2}):?(\d{2}))?$')
+# URI attribute of a tag such as EXT-X-KEY, EXT-X-MAP or EXT-X-MEDIA
+URI_ATTRIBUTE_PATTERN = re.compile(r'([:,]URI=")([^"]*)"')
+
+# Date-time string -> parsed datetime, live playlists repeat the same values on every reload
+date_time_cache = {}
+DATE_TIME_CACHE_SIZE = 4096
+
+
+class FixedOffset(tzinfo):
+    '''
+    A fixed offset from UTC in minutes
+    '''
+
+    def __init__(self, minutes):
+        self.offset = timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        if not self.offset:
+            return 'UTC'
+        minutes = self.offset.days * 1440 + self.offset.seconds // 60
+        return '%s%02d:%02d' % ('-' if minutes < 0 else '+', abs(minutes) // 60, abs(minutes) % 60)
+
+    def __repr__(self):
+        return 'FixedOffset(%s)' % self.tzname(None)
+
+
+utc = FixedOffset(0)
 
 
 def cast_date_time(s):
+    '''
+    Parses a date-time into a timezone aware datetime, values without an offset
+    are taken as UTC. Anything that isn't RFC 3339 goes through parse_iso_date
+    and is read as midnight UTC of that date.
+    '''
+    result = date_time_cache.get(s)
+    if result is None:
+        result = parse_rfc3339(s)
+        if result is None:
+            day = parse_iso_date(s)
+            result = datetime(day.year, day.month, day.day, tzinfo=utc)
+        if len(date_time_cache) >= DATE_TIME_CACHE_SIZE:
+            date_time_cache.clear()
+        date_time_cache[s] = result
+    return result
+
+
+def parse_rfc3339(s):
+    '''
+    Returns the datetime for an RFC 3339 date-time, or None when `s` isn't one
+    '''
+    # Fast path for the usual YYYY-MM-DDTHH:MM:SS.sssZ
+    if len(s) == 24 and s[23] == 'Z' and s[4] == '-' and s[7] == '-' and s[10] == 'T' and s[19] == '.':
+        try:
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]),
+                            int(s[17:19]), int(s[20:23]) * 1000, utc)
+        except ValueError:
+            pass
+
+    m = RFC3339_PATTERN.match(s)
+    if not m:
+        return None
+    year, month, day, hour, minute, second, fraction, sign, offset_hours, offset_minutes = m.groups()
+    timezone = utc
+    if sign:
+        minutes = int(offset_hours) * 60 + int(offset_minutes)
+        if minutes:
+            timezone = FixedOffset(-minutes if sign == '-' else minutes)
+    microsecond = int((fraction + '00000')[:6]) if fraction else 0
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond,
+                        timezone)
+    except ValueError:
+        return None
+
+
+def parse_iso_date(s):
     result = None
     m = re.match(r'^(?P<year>\d{4})-?(?P<month>\d{2})-?(?P<day>\d{2})', s)
     if m:
@@ -100,7 +187,15 @@ def cast_date_time(s):
 
 
 def format_date_time(value):
-    return value.isoformat()
+    '''
+    Formats a datetime as RFC 3339, in milliseconds when that's exact and with Z for UTC
+    '''
+    formatted = value.isoformat()
+    if isinstance(value, datetime) and value.microsecond % 1000 == 0 and value.microsecond:
+        formatted = formatted.replace('.%06d' % value.microsecond, '.%03d' % (value.microsecond // 1000), 1)
+    if formatted.endswith('+00:00'):
+        formatted = formatted[:-6] + 'Z'
+    return formatted
 
 
 class ParseError(Exception):
@@ -116,8 +211,101 @@ class ParseError(Exception):
 def parse(content, strict=False, custom_tags_parser=None):
     '''
     Given a M3U8 playlist content returns a dictionary with all data found
+
+    `custom_tags_parser` is either a callable, called with (line, data, lineno)
+    for every unknown tag, or handlers registered for specific tags: a dict
+    mapping tag names to such callables, or a callable with a `tags` attribute
+    listing the tags it handles.
     '''
-    data = {
+    return parse_lines(string_to_lines(content), strict, custom_tags_parser)
+
+
+def parse_lines(lines, strict=False, custom_tags_parser=None, initial_state=None):
+    '''
+    Parses an iterable of playlist lines, see `parse`.
+    `initial_state` seeds the parser state, e.g. the current key or program date
+    time carried over from segments that precede `lines`.
+    '''
+    data = initial_data()
+    state = initial_parser_state(strict, initial_state)
+    custom_handlers, unknown_tags_parser = custom_tag_handlers(custom_tags_parser)
+
+    # Same as calling parse_line for every line, inlined as this is the hot loop
+    lineno = 0
+    for line in lines:
+        lineno = lineno + 1
+        line = line.strip()
+
+        if line.startswith('#'):
+            colon = line.find(':')
+            tag = line if colon == -1 else line[:colon]
+            handler = TAG_HANDLERS.get(tag)
+            if handler is not None:
+                handler(line, lineno, data, state)
+            else:
+                custom_handler = custom_handlers.get(tag, unknown_tags_parser)
+                if custom_handler is not None:
+                    custom_handler(line, data, lineno)
+
+        elif line == '':
+            pass
+
+        elif state['expect_segment']:
+            parse_ts_chunk(line, data, state)
+            state['expect_segment'] = False
+
+        elif state['expect_playlist']:
+            parse_variant_playlist(line, data, state)
+            state['expect_playlist'] = False
+
+        elif strict:
+            raise ParseError(lineno, line)
+
+        state['previous_line'] = line
+    return data
+
+
+def iterparse(fileobj, strict=False, custom_tags_parser=None, base_uri=None):
+    '''
+    Parses a playlist from a file-like object (anything with a `read` method, such
+    as a file or a transport.StreamingResponse) line by line. Yields
+    ('header', name, value) for playlist attributes as their tags are read and
+    ('segment', Segment) for every segment as soon as its uri line is reached.
+    Segments are not kept, so memory use doesn't grow with the playlist.
+    '''
+    if base_uri is not None and not isinstance(base_uri, UriBase):
+        base_uri = UriBase(base_uri)
+    data = initial_data()
+    state = initial_parser_state(strict)
+    # Only the current key is kept, long live streams rotate through many
+    state['index_keys'] = False
+    state['index_date_times'] = False
+    custom_handlers, unknown_tags_parser = custom_tag_handlers(custom_tags_parser)
+    identity = keyobject = None
+
+    lineno = 0
+    for line in read_lines(fileobj):
+        lineno = lineno + 1
+        line = line.strip()
+        parse_line(line, lineno, data, state, custom_handlers, unknown_tags_parser)
+
+        if data['segments']:
+            segment = data['segments'].pop()
+            keydata = segment.pop('key', None)
+            if keydata and key_data_identity(keydata) != identity:
+                # Segments under the same key share its Key object
+                identity = key_data_identity(keydata)
+                keyobject = Key(base_uri=base_uri, **keydata)
+            yield 'segment', Segment(base_uri=base_uri, keyobject=keyobject if keydata else None, **segment)
+        elif line.startswith('#'):
+            colon = line.find(':')
+            name = HEADER_ATTRIBUTES.get(line if colon == -1 else line[:colon])
+            if name is not None:
+                yield 'header', name, data.get(name)
+
+
+def initial_data():
+    return {
         'media_sequence': 0,
         'is_variant': False,
         'is_endlist': False,
@@ -131,133 +319,292 @@ def parse(content, strict=False, custom_tags_parser=None):
         'keys': []
     }
 
+
+def initial_parser_state(strict, initial_state=None):
     state = {
         'expect_segment': False,
         'expect_playlist': False,
         'current_key': None,
+        'key_index': {},
+        'index_keys': True,
+        'index_date_times': True,
+        'previous_line': '',
+        'strict': strict,
     }
+    if initial_state:
+        state.update(initial_state)
+    return state
+
+
+def parse_line(line, lineno, data, state, custom_handlers, unknown_tags_parser):
+    if line.startswith('#'):
+        colon = line.find(':')
+        tag = line if colon == -1 else line[:colon]
+        handler = TAG_HANDLERS.get(tag)
+        if handler is not None:
+            handler(line, lineno, data, state)
+        else:
+            # Comments and custom tags
+            custom_handler = custom_handlers.get(tag, unknown_tags_parser)
+            if custom_handler is not None:
+                custom_handler(line, data, lineno)
 
-    lineno = 0
-    for line in string_to_lines(content):
-        lineno = lineno + 1
-        line = line.strip()
+    elif line == '':
+        # blank lines are legal
+        pass
 
-        if line.startswith(ext_x_byterange):
-            parse_byterange(line, state)
-            state['expect_segment'] = True
+    elif state['expect_segment']:
+        parse_ts_chunk(line, data, state)
+        state['expect_segment'] = False
 
-        elif line.startswith(ext_x_targetduration):
-            parse_simple_parameter(line, data, float)
+    elif state['expect_playlist']:
+        parse_variant_playlist(line, data, state)
+        state['expect_playlist'] = False
 
-        elif line.startswith(ext_x_media_sequence):
-            parse_simple_parameter(line, data, int)
+    elif state['strict']:
+        raise ParseError(lineno, line)
 
-        elif line.startswith(ext_x_discontinuity_sequence):
-            parse_simple_parameter(line, data, int)
+    state['previous_line'] = line
 
-        elif line.startswith(ext_x_program_date_time):
-            _, program_date_time = parse_simple_parameter_raw_value(line, cast_date_time)
-            if not data.get('program_date_time'):
-                data['program_date_time'] = program_date_time
-            state['current_program_date_time'] = program_date_time
-            state['program_date_time'] = program_date_time
 
-        elif line.startswith(ext_x_discontinuity):
-            state['discontinuity'] = True
+def read_lines(fileobj, chunk_size=READ_CHUNK_SIZE):
+    '''
+    Yields the lines of a file-like object, reading it in chunks
+    '''
+    pending = ''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def custom_tag_handlers(custom_tags_parser):
+    '''
+    Splits `custom_tags_parser` into the handlers registered per tag and
+    the catch-all parser for unknown tags
+    '''
+    if isinstance(custom_tags_parser, dict):
+        return custom_tags_parser, None
+    tags = getattr(custom_tags_parser, 'tags', None)
+    if tags is not None:
+        return dict.fromkeys(tags, custom_tags_parser), None
+    if callable(custom_tags_parser):
+        return {}, custom_tags_parser
+    return {}, None
 
-        elif line.startswith(ext_x_cue_out):
-            parse_cueout(line, state)
-            state['cue_out'] = True
-            state['cue_start'] = True
 
-        elif line.startswith(ext_x_cue_out_start):
-            parse_cueout_start(line, state, string_to_lines(content)[lineno - 2])
-            state['cue_out'] = True
-            state['cue_start'] = True
+def handle_byterange(line, lineno, data, state):
+    parse_byterange(line, state)
+    state['expect_segment'] = True
 
-        elif line.startswith(ext_x_cue_span):
-            state['cue_out'] = True
-            state['cue_start'] = True
 
-        elif line.startswith(ext_x_version):
-            parse_simple_parameter(line, data)
+def handle_float_parameter(line, lineno, data, state):
+    parse_simple_parameter(line, data, float)
 
-        elif line.startswith(ext_x_allow_cache):
-            parse_simple_parameter(line, data)
 
-        elif line.startswith(ext_x_key):
-            key = parse_key(line)
-            state['current_key'] = key
-            if key not in data['keys']:
-                data['keys'].append(key)
+def handle_int_parameter(line, lineno, data, state):
+    parse_simple_parameter(line, data, int)
 
-        elif line.startswith(extinf):
-            parse_extinf(line, data, state, lineno, strict)
-            state['expect_segment'] = True
 
-        elif line.startswith(ext_x_stream_inf):
-            state['expect_playlist'] = True
-            parse_stream_inf(line, data, state)
+def handle_str_parameter(line, lineno, data, state):
+    parse_simple_parameter(line, data)
 
-        elif line.startswith(ext_x_i_frame_stream_inf):
-            parse_i_frame_stream_inf(line, data)
 
-        elif line.startswith(ext_x_media):
-            parse_media(line, data, state)
+def handle_program_date_time(line, lineno, data, state):
+    program_date_time = cast_date_time(line[len(ext_x_program_date_time) + 1:])
+    if not data.get('program_date_time'):
+        data['program_date_time'] = program_date_time
+    state['current_program_date_time'] = program_date_time
+    state['program_date_time'] = program_date_time
 
-        elif line.startswith(ext_x_playlist_type):
-            parse_simple_parameter(line, data)
 
-        elif line.startswith(ext_i_frames_only):
-            data['is_i_frames_only'] = True
+def handle_discontinuity(line, lineno, data, state):
+    state['discontinuity'] = True
 
-        elif line.startswith(ext_is_independent_segments):
-            data['is_independent_segments'] = True
 
-        elif line.startswith(ext_x_endlist):
-            data['is_endlist'] = True
+def handle_cueout(line, lineno, data, state):
+    parse_cueout(line, state)
+    state['cue_out'] = True
+    state['cue_start'] = True
 
-        elif line.startswith(ext_x_map):
-            quoted_parser = remove_quotes_parser('uri')
-            segment_map_info = parse_attribute_list(ext_x_map, line, quoted_parser)
-            data['segment_map'] = segment_map_info
 
-        elif line.startswith(ext_x_start):
-            attribute_parser = {
-                "time_offset": lambda x: float(x)
-            }
-            start_info = parse_attribute_list(ext_x_start, line, attribute_parser)
-            data['start'] = start_info
+def handle_cueout_start(line, lineno, data, state):
+    parse_cueout_start(line, state, state['previous_line'])
+    state['cue_out'] = True
+    state['cue_start'] = True
 
-        # Comments and whitespace
-        elif line.startswith('#'):
-            if callable(custom_tags_parser):
-                custom_tags_parser(line, data, lineno)
 
-        elif line.strip() == '':
-            # blank lines are legal
-            pass
+def handle_cue_span(line, lineno, data, state):
+    state['cue_out'] = True
+    state['cue_start'] = True
 
-        elif state['expect_segment']:
-            parse_ts_chunk(line, data, state)
-            state['expect_segment'] = False
 
-        elif state['expect_playlist']:
+def handle_key(line, lineno, data, state):
+    key = parse_key(line)
+    if not state['index_keys']:
+        state['current_key'] = key
+        return
+    # Repeated keys share the first dict, so segments can be matched to keys by identity
+    identity = key_data_identity(key)
+    interned = state['key_index'].get(identity)
+    if interned is None:
+        interned = state['key_index'][identity] = key
+        data['keys'].append(key)
+    state['current_key'] = interned
+
+
+def handle_extinf(line, lineno, data, state):
+    parse_extinf(line, data, state, lineno, state['strict'])
+    state['expect_segment'] = True
+
+
+def handle_stream_inf(line, lineno, data, state):
+    state['expect_playlist'] = True
+    parse_stream_inf(line, data, state)
+
+
+def handle_i_frame_stream_inf(line, lineno, data, state):
+    parse_i_frame_stream_inf(line, data)
+
+
+def handle_media(line, lineno, data, state):
+    parse_media(line, data, state)
+
+
+def handle_i_frames_only(line, lineno, data, state):
+    data['is_i_frames_only'] = True
+
+
+def handle_independent_segments(line, lineno, data, state):
+    data['is_independent_segments'] = True
+
+
+def handle_endlist(line, lineno, data, state):
+    data['is_endlist'] = True
+
+
+def handle_map(line, lineno, data, state):
+    segment_map_info = parse_attribute_list(ext_x_map, line, MAP_ATTRIBUTES)
+    data['segment_map'] = segment_map_info
+
+
+def handle_start(line, lineno, data, state):
+    start_info = parse_attribute_list(ext_x_start, line, START_ATTRIBUTES)
+    data['start'] = start_info
+
+
+# Tag name (the line up to the first colon) -> handler(line, lineno, data, state)
+TAG_HANDLERS = {
+    ext_x_byterange: handle_byterange,
+    ext_x_targetduration: handle_float_parameter,
+    ext_x_media_sequence: handle_int_parameter,
+    ext_x_discontinuity_sequence: handle_int_parameter,
+    ext_x_program_date_time: handle_program_date_time,
+    ext_x_discontinuity: handle_discontinuity,
+    ext_x_cue_out: handle_cueout,
+    ext_x_cue_out_start: handle_cueout_start,
+    ext_x_cue_span: handle_cue_span,
+    ext_x_version: handle_str_parameter,
+    ext_x_allow_cache: handle_str_parameter,
+    ext_x_key: handle_key,
+    extinf: handle_extinf,
+    ext_x_stream_inf: handle_stream_inf,
+    ext_x_i_frame_stream_inf: handle_i_frame_stream_inf,
+    ext_x_media: handle_media,
+    ext_x_playlist_type: handle_str_parameter,
+    ext_i_frames_only: handle_i_frames_only,
+    ext_is_independent_segments: handle_independent_segments,
+    ext_x_endlist: handle_endlist,
+    ext_x_map: handle_map,
+    ext_x_start: handle_start,
+}
+
+# Tag -> data key of the playlist attribute it sets, reported by iterparse
+HEADER_ATTRIBUTES = {
+    ext_x_targetduration: 'targetduration',
+    ext_x_media_sequence: 'media_sequence',
+    ext_x_discontinuity_sequence: 'discontinuity_sequence',
+    ext_x_version: 'version',
+    ext_x_allow_cache: 'allow_cache',
+    ext_x_playlist_type: 'playlist_type',
+    ext_i_frames_only: 'is_i_frames_only',
+    ext_is_independent_segments: 'is_independent_segments',
+    ext_x_endlist: 'is_endlist',
+    ext_x_map: 'segment_map',
+    ext_x_start: 'start',
+}
+
+VARIANT_TAG_HANDLERS = {
+    ext_x_stream_inf: handle_stream_inf,
+    ext_x_i_frame_stream_inf: handle_i_frame_stream_inf,
+    ext_x_media: handle_media,
+    ext_is_independent_segments: handle_independent_segments,
+}
+
+
+Variants = namedtuple('Variants', ['playlists', 'iframe_playlists', 'media', 'is_independent_segments'])
+
+# Lightweight stand-ins for Playlist and IFramePlaylist, `stream_info` is a StreamInfo
+VariantPlaylist = namedtuple('VariantPlaylist', ['uri', 'base_uri', 'stream_info'])
+
+
+def parse_variants(content, base_uri=None):
+    '''
+    Given a master playlist content returns a Variants tuple with only the
+    EXT-X-STREAM-INF, EXT-X-I-FRAME-STREAM-INF, EXT-X-MEDIA and
+    EXT-X-INDEPENDENT-SEGMENTS tags, without building the M3U8 object model.
+    `media` holds the attribute dicts.
+    Stops at the first segment, media playlists have no variants.
+    '''
+    if base_uri and not base_uri.endswith('/'):
+        base_uri = base_uri + '/'
+    data = {
+        'playlists': [],
+        'iframe_playlists': [],
+        'media': [],
+        'is_independent_segments': False,
+    }
+    state = {
+        'expect_playlist': False,
+    }
+
+    lineno = 0
+    for line in string_to_lines(content):
+        lineno = lineno + 1
+        line = line.strip()
+
+        if line.startswith('#'):
+            colon = line.find(':')
+            tag = line if colon == -1 else line[:colon]
+            handler = VARIANT_TAG_HANDLERS.get(tag)
+            if handler is not None:
+                handler(line, lineno, data, state)
+            elif tag == extinf:
+                break
+
+        elif line and state['expect_playlist']:
             parse_variant_playlist(line, data, state)
             state['expect_playlist'] = False
 
-        elif strict:
-            raise ParseError(lineno, line)
-    return data
+    return Variants(
+        playlists=[VariantPlaylist(playlist['uri'], base_uri, make_stream_info(playlist['stream_info']))
+                   for playlist in data['playlists']],
+        iframe_playlists=[VariantPlaylist(playlist['uri'], base_uri,
+                                          make_iframe_stream_info(playlist['iframe_stream_info']))
+                          for playlist in data['iframe_playlists']],
+        media=data['media'],
+        is_independent_segments=data['is_independent_segments']
+    )
 
 
 def parse_key(line):
-    params = ATTRIBUTELISTPATTERN.split(line.replace(ext_x_key + ':', ''))[1::2]
-    key = {}
-    for param in params:
-        name, value = param.split('=', 1)
-        key[normalize_attribute(name)] = remove_quotes(value)
-    return key
+    return parse_attributes(line[len(ext_x_key) + 1:], {}, remove_quotes)
 
 
 def parse_extinf(line, data, state, lineno, strict):
@@ -282,8 +629,14 @@ def parse_ts_chunk(line, data, state):
         segment['program_date_time'] = state.pop('program_date_time')
     if state.get('current_program_date_time'):
         segment['current_program_date_time'] = state['current_program_date_time']
-        state['current_program_date_time'] = state['current_program_date_time'] + datetime.timedelta(
+        state['current_program_date_time'] = state['current_program_date_time'] + timedelta(
             seconds=segment['duration'])
+        if state['index_date_times']:
+            index = data.get('date_time_index')
+            if index is None:
+                index = data['date_time_index'] = DateTimeIndex()
+            index.add(segment['current_program_date_time'], state['current_program_date_time'],
+                      (data.get('media_sequence') or 0) + len(data['segments']))
     segment['uri'] = line
     segment['cue_out'] = state.pop('cue_out', False)
     if state.get('current_cue_out_scte35'):
@@ -294,43 +647,42 @@ def parse_ts_chunk(line, data, state):
         segment['key'] = state['current_key']
     else:
         # For unencrypted segments, the initial key would be None
-        if None not in data['keys']:
+        if None not in state['key_index']:
+            state['key_index'][None] = None
             data['keys'].append(None)
     data['segments'].append(segment)
 
 
 def parse_attribute_list(prefix, line, atribute_parser):
-    params = ATTRIBUTELISTPATTERN.split(line.replace(prefix + ':', ''))[1::2]
-
-    attributes = {}
-    for param in params:
-        name, value = param.split('=', 1)
-        name = normalize_attribute(name)
-
-        if name in atribute_parser:
-            value = atribute_parser[name](value)
+    return parse_attributes(line[len(prefix) + 1:], atribute_parser)
 
-        attributes[name] = value
 
+def parse_attributes(attribute_list, schema, default=None):
+    '''
+    Parses an attribute list (the part of a tag line after the colon) in a single
+    scan. `schema` maps normalized attribute names to the function that converts
+    their value, `default` converts the others; values are kept as is without one.
+    '''
+    attributes = {}
+    for name, value in ATTRIBUTE_PATTERN.findall(attribute_list):
+        normalized = normalized_names.get(name)
+        if normalized is None:
+            normalized = normalize_attribute(name)
+            if len(normalized_names) < MAX_NORMALIZED_NAMES:
+                normalized_names[name] = normalized
+        cast = schema.get(normalized, default)
+        attributes[normalized] = value if cast is None else cast(value)
     return attributes
 
 
 def parse_stream_inf(line, data, state):
     data['is_variant'] = True
     data['media_sequence'] = None
-    atribute_parser = remove_quotes_parser('codecs', 'audio', 'video', 'subtitles', 'closed_captions')
-    atribute_parser["program_id"] = int
-    atribute_parser["bandwidth"] = lambda x: int(float(x))
-    atribute_parser["average_bandwidth"] = int
-    atribute_parser["frame_rate"] = float
-    state['stream_info'] = parse_attribute_list(ext_x_stream_inf, line, atribute_parser)
+    state['stream_info'] = parse_attribute_list(ext_x_stream_inf, line, STREAM_INF_ATTRIBUTES)
 
 
 def parse_i_frame_stream_inf(line, data):
-    atribute_parser = remove_quotes_parser('codecs', 'uri')
-    atribute_parser["program_id"] = int
-    atribute_parser["bandwidth"] = int
-    iframe_stream_info = parse_attribute_list(ext_x_i_frame_stream_inf, line, atribute_parser)
+    iframe_stream_info = parse_attribute_list(ext_x_i_frame_stream_inf, line, I_FRAME_STREAM_INF_ATTRIBUTES)
     iframe_playlist = {'uri': iframe_stream_info.pop('uri'),
                        'iframe_stream_info': iframe_stream_info}
 
@@ -338,8 +690,7 @@ def parse_i_frame_stream_inf(line, data):
 
 
 def parse_media(line, data, state):
-    quoted = remove_quotes_parser('uri', 'group_id', 'language', 'name', 'characteristics')
-    media = parse_attribute_list(ext_x_media, line, quoted)
+    media = parse_attribute_list(ext_x_media, line, MEDIA_ATTRIBUTES)
     data['media'].append(media)
 
 
@@ -435,22 +786,169 @@ def normalize_attribute(attribute):
     return attribute.replace('-', '_').lower().strip()
 
 
+# Attribute name as written in the playlist -> normalized name, filled by parse_attributes
+normalized_names = {}
+MAX_NORMALIZED_NAMES = 1024
+
+# How the attributes of each tag are converted, see parse_attributes
+STREAM_INF_ATTRIBUTES = remove_quotes_parser('codecs', 'audio', 'video', 'subtitles', 'closed_captions')
+STREAM_INF_ATTRIBUTES.update(program_id=int, bandwidth=lambda x: int(float(x)), average_bandwidth=int,
+                             frame_rate=float)
+I_FRAME_STREAM_INF_ATTRIBUTES = remove_quotes_parser('codecs', 'uri')
+I_FRAME_STREAM_INF_ATTRIBUTES.update(program_id=int, bandwidth=int)
+MEDIA_ATTRIBUTES = remove_quotes_parser('uri', 'group_id', 'language', 'name', 'characteristics')
+MAP_ATTRIBUTES = remove_quotes_parser('uri')
+START_ATTRIBUTES = {'time_offset': float}
+
+
 def is_url(uri):
     return uri.startswith(('https://', 'http://'))
 
 
+class UriBase(object):
+    '''
+    The base uri and base path of a playlist, shared by its segments, keys, media
+    and variants so re-basing the playlist is a single assignment. Absolute and
+    re-based uris are cached until either changes.
+    '''
+
+    def __init__(self, uri=None, path=None):
+        self.the_uri = uri
+        self.the_path = path
+        self.reset()
+
+    @property
+    def uri(self):
+        return self.the_uri
+
+    @uri.setter
+    def uri(self, new_uri):
+        self.the_uri = new_uri
+        self.reset()
+
+    @property
+    def path(self):
+        return self.the_path
+
+    @path.setter
+    def path(self, new_path):
+        self.the_path = new_path
+        self.reset()
+
+    def reset(self):
+        self.resolved = {}
+        self.rebased = {}
+        # Relative uris without dot segments are resolved by appending them to this
+        self.prefix = None
+        if self.the_uri and is_url(self.the_uri):
+            parts = urlparse(self.the_uri)
+            if '/' in parts.path and not (parts.params or parts.query or parts.fragment):
+                self.prefix = '%s://%s%s' % (parts.scheme, parts.netloc, parts.path[:parts.path.rfind('/') + 1])
+
+    def rebase(self, uri):
+        '''
+        Returns `uri` with its directory replaced by the base path
+        '''
+        rebased = self.rebased.get(uri)
+        if rebased is None:
+            dirname = os.path.dirname(uri)
+            if not dirname:
+                rebased = '%s/%s' % (self.the_path, uri)
+            else:
+                rebased = uri.replace(dirname, self.the_path)
+            remember(self.rebased, uri, rebased)
+        return rebased
+
+    def resolve(self, uri):
+        '''
+        Returns the absolute uri for `uri` relative to the base uri
+        '''
+        resolved = self.resolved.get(uri)
+        if resolved is None:
+            if is_url(uri):
+                return uri
+            if self.the_uri is None:
+                raise ValueError('There can not be `absolute_uri` with no `base_uri` set')
+            if self.prefix is not None and is_plain_relative(uri):
+                resolved = self.prefix + uri
+            else:
+                resolved = urijoin(self.the_uri, uri)
+            remember(self.resolved, uri, resolved)
+        return resolved
+
+
+# Entries kept in each UriBase cache before it is cleared
+MAX_CACHED_URIS = 64 * 1024
+
+
+def uri_base_for(base_uri):
+    '''
+    Returns the UriBase for a base uri given as a string, or the one given
+    '''
+    if base_uri is None or isinstance(base_uri, UriBase):
+        return base_uri
+    return UriBase(base_uri)
+
+
+def remember(cache, uri, value):
+    if len(cache) >= MAX_CACHED_URIS:
+        cache.clear()
+    cache[uri] = value
+
+
+def is_plain_relative(uri):
+    '''
+    Whether `uri` is a relative path that urljoin would simply append to the base
+    directory: no scheme, no leading slash, query or fragment and no dot segments
+    '''
+    if not uri or uri[0] in '/?#.' or ':' in uri.partition('/')[0]:
+        return False
+    return './' not in uri and not uri.endswith('/.') and not uri.endswith('/..')
+
+
 class BasePathMixin(object):
+    '''
+    `base_uri` and `base_path` are kept in a UriBase, normally the one shared
+    by the whole playlist. Setting either on a single item gives it a UriBase of
+    its own. `uri` is read with `base_path` applied.
+    '''
+
+    uri_base = None
+    the_uri = None
+
+    @property
+    def uri(self):
+        uri_base = self.uri_base
+        if uri_base is None or uri_base.the_path is None or self.the_uri is None:
+            return self.the_uri
+        return uri_base.rebase(self.the_uri)
+
+    @uri.setter
+    def uri(self, newuri):
+        self.the_uri = newuri
 
     @property
     def absolute_uri(self):
-        if self.uri is None:
+        uri = self.uri
+        if uri is None:
             return None
-        if is_url(self.uri):
-            return self.uri
-        else:
-            if self.base_uri is None:
-                raise ValueError('There can not be `absolute_uri` with no `base_uri` set')
-            return urijoin(self.base_uri, self.uri)
+        if self.uri_base is None:
+            if is_url(uri):
+                return uri
+            raise ValueError('There can not be `absolute_uri` with no `base_uri` set')
+        return self.uri_base.resolve(uri)
+
+    @property
+    def base_uri(self):
+        return self.uri_base and self.uri_base.the_uri
+
+    @base_uri.setter
+    def base_uri(self, newbase_uri):
+        if isinstance(newbase_uri, UriBase):
+            self.uri_base = newbase_uri
+            return
+        path = self.uri_base and self.uri_base.the_path
+        self.uri_base = None if newbase_uri is None and path is None else UriBase(newbase_uri, path)
 
     @property
     def base_path(self):
@@ -461,10 +959,7 @@ class BasePathMixin(object):
     @base_path.setter
     def base_path(self, newbase_path):
         if self.uri is not None:
-            if not self.base_path:
-                self.uri = "%s/%s" % (newbase_path, self.uri)
-            else:
-                self.uri = self.uri.replace(self.base_path, newbase_path)
+            self.uri_base = UriBase(self.base_uri, newbase_path)
 
 
 class GroupedBasePathMixin(object):
@@ -482,6 +977,24 @@ class GroupedBasePathMixin(object):
     base_path = property(None, set_base_path)
 
 
+class lazy_attribute(object):
+    '''
+    Decorator for a method that computes an attribute on first access, the result
+    is stored on the instance and replaces the method from then on
+    '''
+
+    def __init__(self, build):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.build(instance)
+        return value
+
+
 class M3U8(object):
     simple_attributes = (
         # obj attribute      # parser attribute
@@ -498,88 +1011,149 @@ class M3U8(object):
         ('discontinuity_sequence', 'discontinuity_sequence')
     )
 
-    def __init__(self, content=None, base_path=None, base_uri=None, strict=False, custom_tags_parser=None):
-        if content is not None:
+    def __init__(self, content=None, base_path=None, base_uri=None, strict=False, custom_tags_parser=None,
+                 data=None, compact=False):
+        self.compact = compact
+        if data is not None:
+            self.data = data
+        elif content is not None:
             self.data = parse(content, strict, custom_tags_parser)
         else:
             self.data = {}
-        self.the_base_uri = base_uri
-        if self.the_base_uri:
-            if not self.the_base_uri.endswith('/'):
-                self.the_base_uri = self.the_base_uri + '/'
+        if isinstance(base_uri, UriBase):
+            # Shared with another playlist, as LivePlaylist does between reloads
+            self.uri_base = base_uri
+        else:
+            if base_uri and not base_uri.endswith('/'):
+                base_uri = base_uri + '/'
+            self.uri_base = UriBase(base_uri)
+        self.dumped_header = None
 
         self.initialize_attributes()
-        self.base_path = base_path
+        if base_path is not None:
+            self.base_path = base_path
 
     def initialize_attributes(self):
-        self.keys = [Key(base_uri=self.base_uri, **params) if params else None
-                     for params in self.data.get('keys', [])]
-        self.segments = SegmentList(
-            [Segment(base_uri=self.base_uri, keyobject=find_key(segment.get('key', {}), self.keys), **segment)
-             for segment in self.data.get('segments', [])])
+        '''
+        Sets the simple attributes. keys, segments, files, media, playlists and
+        iframe_playlists are only built from the parsed data when first accessed.
+        '''
         for attr, param in self.simple_attributes:
-            try:
-                if attr in self.data:
-                    setattr(self, attr, self.data.get(param))
-            except:
-                Log("Attribute " + attr + " not settable?")
+            setattr(self, attr, self.data.get(param))
+        self.segment_map = self.data.get('segment_map')
 
-        self.files = []
-        for key in self.keys:
-            # Avoid None key, it could be the first one, don't repeat them
-            if key and key.uri not in self.files:
-                self.files.append(key.uri)
-        self.files.extend(self.segments.uri)
+        start = self.data.get('start', None)
+        self.start = start and Start(**start)
 
-        self.media = MediaList([Media(base_uri=self.base_uri, **media)
-                                for media in self.data.get('media', [])])
+    @lazy_attribute
+    def keys(self):
+        return [Key(base_uri=self.uri_base, **params) if params else None
+                for params in self.data.get('keys', [])]
 
-        self.playlists = PlaylistList([Playlist(base_uri=self.base_uri, media=self.media, **playlist)
-                                       for playlist in self.data.get('playlists', [])])
+    @lazy_attribute
+    def segments(self):
+        keys = dict((key_data_identity(params), key)
+                    for params, key in zip(self.data.get('keys', []), self.keys) if params)
 
-        self.iframe_playlists = PlaylistList()
-        for ifr_pl in self.data.get('iframe_playlists', []):
-            self.iframe_playlists.append(IFramePlaylist(base_uri=self.base_uri,
-                                                        uri=ifr_pl['uri'],
-                                                        iframe_stream_info=ifr_pl['iframe_stream_info'])
-                                         )
-        self.segment_map = self.data.get('segment_map')
+        def keyobject(segment):
+            keydata = segment.get('key')
+            return keys[key_data_identity(keydata)] if keydata else None
 
-        start = self.data.get('start', None)
-        self.start = start and Start(**start)
+        if self.compact:
+            segments = SegmentTable(base_uri=self.uri_base)
+            for segment in self.data.get('segments', []):
+                segments.append_fields(keyobject=keyobject(segment), **segment)
+        else:
+            segments = SegmentList(
+                [Segment(base_uri=self.uri_base, keyobject=keyobject(segment), **segment)
+                 for segment in self.data.get('segments', [])])
+        return segments
+
+    @lazy_attribute
+    def files(self):
+        files = []
+        for key in self.keys:
+            # Avoid None key, it could be the first one, don't repeat them
+            if key and key.uri not in files:
+                files.append(key.uri)
+        files.extend(self.segments.uri)
+        return files
+
+    @lazy_attribute
+    def media(self):
+        return MediaList([Media(base_uri=self.uri_base, **media)
+                          for media in self.data.get('media', [])])
+
+    @lazy_attribute
+    def playlists(self):
+        return PlaylistList([Playlist(base_uri=self.uri_base, media=self.media, **playlist)
+                             for playlist in self.data.get('playlists', [])])
+
+    @lazy_attribute
+    def iframe_playlists(self):
+        iframe_playlists = PlaylistList()
+        for ifr_pl in self.data.get('iframe_playlists', []):
+            iframe_playlists.append(IFramePlaylist(base_uri=self.uri_base,
+                                                   uri=ifr_pl['uri'],
+                                                   iframe_stream_info=ifr_pl['iframe_stream_info'])
+                                    )
+        return iframe_playlists
 
     @property
     def base_uri(self):
-        return self.the_base_uri
+        return self.uri_base.uri
 
     @base_uri.setter
     def base_uri(self, newbase_uri):
-        self.the_base_uri = newbase_uri
-        self.media.base_uri = newbase_uri
-        self.playlists.base_uri = newbase_uri
-        self.segments.base_uri = newbase_uri
-        for key in self.keys:
-            if key:
-                key.base_uri = newbase_uri
+        # Every item built from this playlist shares uri_base, items given a
+        # base of their own keep it
+        self.uri_base.uri = newbase_uri
 
     @property
     def base_path(self):
-        return self.the_base_path
+        return self.uri_base.path
 
     @base_path.setter
     def base_path(self, newbase_path):
-        self.the_base_path = newbase_path
-        self.update_base_path()
+        self.uri_base.path = newbase_path
+
+    @lazy_attribute
+    def date_time_index(self):
+        index = self.data.get('date_time_index')
+        if index is None:
+            # Not parsed by parse_lines, index the segments once
+            index = DateTimeIndex()
+            first = self.media_sequence or 0
+            for position, segment in enumerate(self.segments):
+                if segment.current_program_date_time:
+                    index.add(segment.current_program_date_time,
+                              segment.current_program_date_time + timedelta(seconds=segment.duration),
+                              first + position)
+        return index
+
+    def segment_at(self, when):
+        '''
+        Returns the segment playing at the datetime `when` going by the program date
+        times, or None. Naive datetimes are taken as UTC.
+        '''
+        number = self.date_time_index.number_at(when)
+        if number is None:
+            return None
+        segments = self.segments_numbered([number])
+        return segments[0] if segments else None
 
-    def update_base_path(self):
-        if self.the_base_path is None:
-            return
-        for key in self.keys:
-            if key:
-                key.base_path = self.the_base_path
-        self.media.base_path = self.the_base_path
-        self.segments.base_path = self.the_base_path
-        self.playlists.base_path = self.the_base_path
+    def segments_between(self, start, end):
+        '''
+        Returns the segments that play between the datetimes `start` and `end`
+        in wall clock order
+        '''
+        return self.segments_numbered(self.date_time_index.numbers_between(start, end))
+
+    def segments_numbered(self, numbers):
+        first = self.media_sequence or 0
+        segments = self.segments
+        return SegmentList(segments[number - first] for number in numbers
+                           if 0 <= number - first < len(segments))
 
     def add_playlist(self, playlist):
         self.is_variant = True
@@ -595,12 +1169,55 @@ class M3U8(object):
 
     def add_segment(self, segment):
         self.segments.append(segment)
+        # Keep an index already built in step with the segments, including the one
+        # parse_lines built that date_time_index has not read yet
+        index = self.__dict__.get('date_time_index', self.data.get('date_time_index'))
+        start = segment.current_program_date_time or segment.program_date_time
+        if index is not None and start:
+            index.add(start, start + timedelta(seconds=segment.duration or 0),
+                      (self.media_sequence or 0) + len(self.segments) - 1)
 
     def dumps(self):
         '''
         Returns the current m3u8 as a string.
         You could also use unicode(<this obj>) or str(<this obj>)
         '''
+        return ''.join(self.iterdumps())
+
+    def iterdumps(self):
+        '''
+        Yields the current m3u8 in pieces that add up to `dumps`, without building
+        the whole string. The header and the text of segments that haven't changed
+        are reused from the previous call.
+        '''
+        parts = [[self.dump_header()]]
+        if self.is_variant:
+            if self.media:
+                parts.append(['\n'])
+                parts.append(join_lines(str(media) for media in self.media))
+            parts.append(['\n'])
+            parts.append(join_lines(str(playlist) for playlist in self.playlists))
+            if self.iframe_playlists:
+                parts.append(['\n'])
+                parts.append(join_lines(str(playlist) for playlist in self.iframe_playlists))
+        parts.append(['\n'])
+        parts.append(self.segments.iterdumps())
+
+        if self.is_endlist:
+            parts.append(['\n#EXT-X-ENDLIST'])
+        return itertools.chain.from_iterable(parts)
+
+    def dump_header(self):
+        '''
+        Returns the tags that come before the variants and segments
+        '''
+        state = (self.is_independent_segments, self.media_sequence, self.discontinuity_sequence,
+                 self.allow_cache, self.version, self.target_duration, self.playlist_type,
+                 self.start and str(self.start), self.is_i_frames_only,
+                 self.segment_map and sorted(self.segment_map.items()))
+        if self.dumped_header is not None and self.dumped_header[0] == state:
+            return self.dumped_header[1]
+
         output = ['#EXTM3U']
         if self.is_independent_segments:
             output.append('#EXT-X-INDEPENDENT-SEGMENTS')
@@ -629,18 +1246,17 @@ class M3U8(object):
             if self.segment_map.get('byterange'):
                 map_output.append('BYTERANGE=' + self.segment_map['byterange'])
             output.append('#EXT-X-MAP:' + ','.join(map_output))
-        if self.is_variant:
-            if self.media:
-                output.append(str(self.media))
-            output.append(str(self.playlists))
-            if self.iframe_playlists:
-                output.append(str(self.iframe_playlists))
-        output.append(str(self.segments))
 
-        if self.is_endlist:
-            output.append('#EXT-X-ENDLIST')
+        header = '\n'.join(output)
+        self.dumped_header = (state, header)
+        return header
 
-        return '\n'.join(output)
+    def write(self, fileobj):
+        '''
+        Writes the current m3u8 to a file-like object piece by piece
+        '''
+        for text in self.iterdumps():
+            fileobj.write(text)
 
     def dump(self, filename):
         '''
@@ -649,7 +1265,7 @@ class M3U8(object):
         self.create_sub_directories(filename)
 
         with open(filename, 'w') as fileobj:
-            fileobj.write(self.dumps())
+            self.write(fileobj)
 
     def create_sub_directories(self, filename):
         basename = os.path.dirname(filename)
@@ -711,10 +1327,10 @@ class Segment(BasePathMixin):
                  duration=None, title=None, byterange=None, cue_out=False,
                  discontinuity=False, key=None, scte35=None, scte35_duration=None,
                  keyobject=None):
-        self.uri = uri
+        self.the_uri = uri
         self.duration = duration
         self.title = title
-        self.base_uri = base_uri
+        self.uri_base = uri_base_for(base_uri)
         self.byterange = byterange
         self.program_date_time = program_date_time
         self.current_program_date_time = current_program_date_time
@@ -724,18 +1340,27 @@ class Segment(BasePathMixin):
         self.scte35_duration = scte35_duration
         self.key = keyobject
         # Key(base_uri=base_uri, **key) if key else None
+        self.dumped = None
 
     def dumps(self, last_segment):
-        output = []
         if last_segment and self.key != last_segment.key:
-            output.append(str(self.key))
-            output.append('\n')
-        else:
-            # The key must be checked anyway now for the first segment
-            if self.key and last_segment is None:
-                output.append(str(self.key))
-                output.append('\n')
+            return str(self.key) + '\n' + self.dump_tags()
+        # The key must be checked anyway now for the first segment
+        if self.key and last_segment is None:
+            return str(self.key) + '\n' + self.dump_tags()
+        return self.dump_tags()
 
+    def dump_tags(self):
+        '''
+        Returns the segment's tags and uri, reusing the text from the previous
+        call when none of them changed
+        '''
+        state = (self.uri, self.duration, self.title, self.byterange, self.discontinuity,
+                 self.program_date_time, self.cue_out)
+        if self.dumped is not None and self.dumped[0] == state:
+            return self.dumped[1]
+
+        output = []
         if self.discontinuity:
             output.append('#EXT-X-DISCONTINUITY\n')
         if self.program_date_time:
@@ -754,28 +1379,408 @@ class Segment(BasePathMixin):
 
         output.append(self.uri)
 
-        return ''.join(output)
+        text = ''.join(output)
+        self.dumped = (state, text)
+        return text
 
     def __str__(self):
         return self.dumps(None)
 
 
+def drops_key_index(method):
+    def wrapper(self, *args, **kwargs):
+        self.key_index = None
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
 class SegmentList(list, GroupedBasePathMixin):
+    '''
+    `by_key` looks segments up in an index built on its first call, changing the
+    list drops the index. Assigning another key to a segment already in the list
+    is not noticed.
+    '''
+
+    key_index = None
+
+    append = drops_key_index(list.append)
+    extend = drops_key_index(list.extend)
+    insert = drops_key_index(list.insert)
+    pop = drops_key_index(list.pop)
+    remove = drops_key_index(list.remove)
+    reverse = drops_key_index(list.reverse)
+    sort = drops_key_index(list.sort)
+    __setitem__ = drops_key_index(list.__setitem__)
+    __delitem__ = drops_key_index(list.__delitem__)
+    __setslice__ = drops_key_index(list.__setslice__)
+    __delslice__ = drops_key_index(list.__delslice__)
+    __iadd__ = drops_key_index(list.__iadd__)
+    __imul__ = drops_key_index(list.__imul__)
 
     def __str__(self):
-        output = []
-        last_segment = None
-        for segment in self:
-            output.append(segment.dumps(last_segment))
-            last_segment = segment
-        return '\n'.join(output)
+        return ''.join(self.iterdumps())
+
+    def iterdumps(self):
+        return dump_segments(self)
 
     @property
     def uri(self):
         return [seg.uri for seg in self]
 
+    def absolute_uris(self):
+        '''
+        Returns the absolute uri of every segment
+        '''
+        return [segment.absolute_uri for segment in self]
+
     def by_key(self, key):
-        return [segment for segment in self if segment.key == key]
+        if self.key_index is None:
+            key_index = {}
+            for segment in self:
+                key_index.setdefault(id(segment.key), []).append(segment)
+            self.key_index = key_index
+        return list(self.key_index.get(id(key), []))
+
+    def total_duration(self):
+        return math.fsum(segment.duration for segment in self)
+
+    def discontinuities(self):
+        '''
+        Returns the positions of the segments that start a discontinuity
+        '''
+        return [position for position, segment in enumerate(self) if segment.discontinuity]
+
+
+def dump_segments(segments):
+    '''
+    Yields the text of each segment, separated by newlines
+    '''
+    last_segment = None
+    for segment in segments:
+        if last_segment is None:
+            yield segment.dumps(None)
+        else:
+            yield '\n' + segment.dumps(last_segment)
+        last_segment = segment
+
+
+def join_lines(lines):
+    '''
+    Yields the lines separated by newlines, like '\\n'.join without building the string
+    '''
+    first = True
+    for line in lines:
+        if first:
+            yield line
+            first = False
+        else:
+            yield '\n' + line
+
+
+class StringPool(object):
+    '''
+    Stores each distinct string once and hands out integer references to it, -1 stands for None
+    '''
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+
+    def add(self, string):
+        if string is None:
+            return -1
+        reference = self.index.get(string)
+        if reference is None:
+            reference = self.index[string] = len(self.strings)
+            self.strings.append(string)
+        return reference
+
+    def get(self, reference):
+        return None if reference < 0 else self.strings[reference]
+
+
+class SegmentTable(GroupedBasePathMixin):
+    '''
+    Compact replacement for SegmentList. Segment fields are held in typed array
+    columns and string pools instead of one object per segment, a Segment is
+    created each time one is accessed. Such a Segment is a copy, assign it back
+    with `table[i] = segment` to store changes.
+
+    Supports the SegmentList API, plus column based `total_duration` and
+    `discontinuities`.
+    '''
+
+    def __init__(self, segments=(), base_uri=None):
+        self.uri_base = base_uri if isinstance(base_uri, UriBase) else UriBase(base_uri)
+        self.uris = StringPool()
+        self.titles = StringPool()
+        self.byteranges = StringPool()
+        self.keys = []
+        self.key_references = {}
+        self.uri_column = array.array('l')
+        self.title_column = array.array('l')
+        self.byterange_column = array.array('l')
+        self.key_column = array.array('l')
+        self.duration_column = array.array('d')
+        self.discontinuity_column = array.array('B')
+        self.cue_out_column = array.array('B')
+        # current_program_date_time as seconds from the first one seen, NaN when unset
+        self.date_time_anchor = None
+        self.date_time_column = array.array('d')
+        # Fields only a few segments carry: position -> {field: value}
+        self.sparse = {}
+        for segment in segments:
+            self.append(segment)
+
+    def append(self, segment):
+        self.append_fields(segment.uri, segment.base_uri, segment.program_date_time,
+                           segment.current_program_date_time, segment.duration, segment.title,
+                           segment.byterange, segment.cue_out, segment.discontinuity,
+                           scte35=segment.scte35, scte35_duration=segment.scte35_duration,
+                           keyobject=segment.key)
+
+    def append_fields(self, uri, base_uri=None, program_date_time=None, current_program_date_time=None,
+                      duration=None, title=None, byterange=None, cue_out=False,
+                      discontinuity=False, key=None, scte35=None, scte35_duration=None,
+                      keyobject=None):
+        '''
+        Appends a segment given the arguments of Segment, without creating it
+        '''
+        for column in (self.uri_column, self.title_column, self.byterange_column, self.key_column):
+            column.append(-1)
+        for column in (self.duration_column, self.date_time_column):
+            column.append(0.0)
+        for column in (self.discontinuity_column, self.cue_out_column):
+            column.append(0)
+        self.store(len(self.uri_column) - 1, uri, program_date_time, current_program_date_time, duration, title,
+                   byterange, cue_out, discontinuity, scte35, scte35_duration, keyobject)
+
+    def store(self, position, uri, program_date_time, current_program_date_time, duration, title,
+              byterange, cue_out, discontinuity, scte35, scte35_duration, keyobject):
+        self.uri_column[position] = self.uris.add(uri)
+        self.title_column[position] = self.titles.add(title)
+        self.byterange_column[position] = self.byteranges.add(byterange)
+        self.key_column[position] = self.key_reference(keyobject)
+        self.duration_column[position] = float('nan') if duration is None else duration
+        self.discontinuity_column[position] = 1 if discontinuity else 0
+        self.cue_out_column[position] = 1 if cue_out else 0
+        if current_program_date_time is None:
+            self.date_time_column[position] = float('nan')
+        else:
+            if self.date_time_anchor is None:
+                self.date_time_anchor = current_program_date_time
+            self.date_time_column[position] = seconds_between(self.date_time_anchor, current_program_date_time)
+        if program_date_time is not None or scte35 is not None or scte35_duration is not None:
+            self.sparse[position] = {
+                'program_date_time': program_date_time,
+                'scte35': scte35,
+                'scte35_duration': scte35_duration,
+            }
+        else:
+            self.sparse.pop(position, None)
+
+    def extend(self, segments):
+        for segment in segments:
+            self.append(segment)
+
+    def key_reference(self, key):
+        if key is None:
+            return -1
+        reference = self.key_references.get(id(key))
+        if reference is None:
+            reference = self.key_references[id(key)] = len(self.keys)
+            self.keys.append(key)
+        return reference
+
+    def segment(self, position):
+        duration = self.duration_column[position]
+        offset = self.date_time_column[position]
+        extras = self.sparse.get(position, {})
+        key = self.key_column[position]
+        return Segment(
+            self.uris.get(self.uri_column[position]), self.uri_base,
+            program_date_time=extras.get('program_date_time'),
+            current_program_date_time=None if offset != offset else
+            self.date_time_anchor + timedelta(seconds=offset),
+            duration=None if duration != duration else duration,
+            title=self.titles.get(self.title_column[position]),
+            byterange=self.byteranges.get(self.byterange_column[position]),
+            cue_out=bool(self.cue_out_column[position]),
+            discontinuity=bool(self.discontinuity_column[position]),
+            scte35=extras.get('scte35'),
+            scte35_duration=extras.get('scte35_duration'),
+            keyobject=None if key < 0 else self.keys[key])
+
+    def __len__(self):
+        return len(self.uri_column)
+
+    def __iter__(self):
+        for position in xrange(len(self)):
+            yield self.segment(position)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return SegmentList(self.segment(i) for i in xrange(*position.indices(len(self))))
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('segment index out of range')
+        return self.segment(position)
+
+    def __setitem__(self, position, segment):
+        if position < 0:
+            position += len(self)
+        self.store(position, segment.uri, segment.program_date_time, segment.current_program_date_time,
+                   segment.duration, segment.title, segment.byterange, segment.cue_out, segment.discontinuity,
+                   segment.scte35, segment.scte35_duration, segment.key)
+
+    def __str__(self):
+        return ''.join(self.iterdumps())
+
+    def iterdumps(self):
+        return dump_segments(self)
+
+    @property
+    def uri(self):
+        strings = self.uris.strings
+        if self.uri_base.path is not None:
+            strings = [self.uri_base.rebase(string) for string in strings]
+        return [strings[reference] for reference in self.uri_column]
+
+    def absolute_uris(self):
+        '''
+        Returns the absolute uri of every segment, resolving each distinct uri once
+        '''
+        uri_base = self.uri_base
+        strings = self.uris.strings
+        if uri_base.path is not None:
+            strings = [uri_base.rebase(string) for string in strings]
+        resolved = [uri_base.resolve(string) for string in strings]
+        return [resolved[reference] for reference in self.uri_column]
+
+    def by_key(self, key):
+        reference = -1 if key is None else self.key_references.get(id(key))
+        if reference is None:
+            return []
+        return [self.segment(position) for position, segment_key in enumerate(self.key_column)
+                if segment_key == reference]
+
+    def total_duration(self):
+        return math.fsum(duration for duration in self.duration_column if duration == duration)
+
+    def discontinuities(self):
+        '''
+        Returns the positions of the segments that start a discontinuity
+        '''
+        flags = self.discontinuity_column.tostring()
+        positions = []
+        position = flags.find('\x01')
+        while position != -1:
+            positions.append(position)
+            position = flags.find('\x01', position + 1)
+        return positions
+
+    def set_base_uri(self, new_base_uri):
+        self.uri_base = UriBase(new_base_uri, self.uri_base.path)
+
+    base_uri = property(lambda self: self.uri_base.uri, set_base_uri)
+
+    def set_base_path(self, newbase_path):
+        self.uri_base = UriBase(self.uri_base.uri, newbase_path)
+
+    base_path = property(None, set_base_path)
+
+
+class DateTimeIndex(object):
+    '''
+    Segments sorted by the wall clock time they start at (current_program_date_time),
+    to find them by time with bisection. Segments are identified by their media
+    sequence number.
+    '''
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.numbers = []
+        # Whether numbers are ascending too, true unless the program date time jumps back
+        self.ordered = True
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def add(self, start, end, number):
+        start = aware(start)
+        end = aware(end)
+        starts = self.starts
+        numbers = self.numbers
+        if not starts or start >= starts[-1]:
+            if numbers and number < numbers[-1]:
+                self.ordered = False
+            starts.append(start)
+            self.ends.append(end)
+            numbers.append(number)
+            return
+        # Program date time went back
+        position = bisect.bisect_right(starts, start)
+        self.ordered = False
+        starts.insert(position, start)
+        self.ends.insert(position, end)
+        numbers.insert(position, number)
+
+    def number_at(self, when):
+        '''
+        Returns the number of the segment playing at `when`, or None
+        '''
+        when = aware(when)
+        position = bisect.bisect_right(self.starts, when) - 1
+        if position >= 0 and when < self.ends[position]:
+            return self.numbers[position]
+        return None
+
+    def numbers_between(self, start, end):
+        '''
+        Returns the numbers of the segments playing at any time from `start` until `end`
+        '''
+        start = aware(start)
+        end = aware(end)
+        first = bisect.bisect_right(self.starts, start) - 1
+        if first < 0 or self.ends[first] <= start:
+            first = first + 1
+        return self.numbers[first:bisect.bisect_left(self.starts, end)]
+
+    def since(self, number):
+        '''
+        Returns a new index without the segments numbered below `number`
+        '''
+        index = DateTimeIndex()
+        if self.ordered:
+            first = bisect.bisect_left(self.numbers, number)
+            index.starts = self.starts[first:]
+            index.ends = self.ends[first:]
+            index.numbers = self.numbers[first:]
+        else:
+            for start, end, kept in zip(self.starts, self.ends, self.numbers):
+                if kept >= number:
+                    index.starts.append(start)
+                    index.ends.append(end)
+                    index.numbers.append(kept)
+            index.ordered = index.numbers == sorted(index.numbers)
+        return index
+
+
+def aware(value):
+    '''
+    Returns the datetime with UTC as timezone when it has none
+    '''
+    if value.tzinfo is None:
+        return value.replace(tzinfo=utc)
+    return value
+
+
+def seconds_between(start, end):
+    delta = end - start
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
 
 
 class Key(BasePathMixin):
@@ -798,11 +1803,11 @@ class Key(BasePathMixin):
 
     def __init__(self, method, base_uri, uri=None, iv=None, keyformat=None, keyformatversions=None):
         self.method = method
-        self.uri = uri
+        self.the_uri = uri
         self.iv = iv
         self.keyformat = keyformat
         self.keyformatversions = keyformatversions
-        self.base_uri = base_uri
+        self.uri_base = uri_base_for(base_uri)
 
     def __str__(self):
         output = [
@@ -849,36 +1854,45 @@ class Playlist(BasePathMixin):
     '''
 
     def __init__(self, uri, stream_info, media, base_uri):
-        self.uri = uri
-        self.base_uri = base_uri
-
-        resolution = stream_info.get('resolution')
-        if resolution != None:
-            resolution = resolution.strip('"')
-            values = resolution.split('x')
-            resolution_pair = (int(values[0]), int(values[1]))
-        else:
-            resolution_pair = None
-
-        self.stream_info = StreamInfo(
-            bandwidth=stream_info['bandwidth'],
-            video=stream_info.get('video'),
-            audio=stream_info.get('audio'),
-            subtitles=stream_info.get('subtitles'),
-            closed_captions=stream_info.get('closed_captions'),
-            average_bandwidth=stream_info.get('average_bandwidth'),
-            program_id=stream_info.get('program_id'),
-            resolution=resolution_pair,
-            codecs=stream_info.get('codecs'),
-            frame_rate=stream_info.get('frame_rate')
-        )
+        self.the_uri = uri
+        self.uri_base = uri_base_for(base_uri)
+        self.stream_info = make_stream_info(stream_info)
         self.media = []
         for media_type in ('audio', 'video', 'subtitles'):
-            group_id = stream_info.get(media_type)
+            group_id = getattr(self.stream_info, media_type)
             if not group_id:
                 continue
 
-            self.media = media + filter(lambda m: m.group_id == group_id, media)
+            self.media += filter(lambda m: m.group_id == group_id, media)
+
+    def __str__(self):
+        stream_inf = []
+        if self.stream_info.program_id:
+            stream_inf.append('PROGRAM-ID=%d' % self.stream_info.program_id)
+        if self.stream_info.bandwidth:
+            stream_inf.append('BANDWIDTH=%d' % self.stream_info.bandwidth)
+        if self.stream_info.average_bandwidth:
+            stream_inf.append('AVERAGE-BANDWIDTH=%d' % self.stream_info.average_bandwidth)
+        if self.stream_info.resolution:
+            res = (str(self.stream_info.resolution[0]) + 'x' +
+                   str(self.stream_info.resolution[1]))
+            stream_inf.append('RESOLUTION=' + res)
+        if self.stream_info.frame_rate:
+            stream_inf.append('FRAME-RATE=%g' % self.stream_info.frame_rate)
+        if self.stream_info.codecs:
+            stream_inf.append('CODECS=' + quoted(self.stream_info.codecs))
+        for media_type in ('audio', 'video', 'subtitles'):
+            group_id = getattr(self.stream_info, media_type)
+            if group_id:
+                stream_inf.append(media_type.upper() + '=' + quoted(group_id))
+        if self.stream_info.closed_captions:
+            closed_captions = self.stream_info.closed_captions
+            # NONE is an enumerated string, group ids are quoted
+            if closed_captions != 'NONE':
+                closed_captions = quoted(closed_captions)
+            stream_inf.append('CLOSED-CAPTIONS=' + closed_captions)
+
+        return '#EXT-X-STREAM-INF:' + ','.join(stream_inf) + '\n' + self.uri
 
 
 class IFramePlaylist(BasePathMixin):
@@ -896,30 +1910,9 @@ class IFramePlaylist(BasePathMixin):
     '''
 
     def __init__(self, base_uri, uri, iframe_stream_info):
-        self.uri = uri
-        self.base_uri = base_uri
-
-        resolution = iframe_stream_info.get('resolution')
-        if resolution is not None:
-            values = resolution.split('x')
-            resolution_pair = (int(values[0]), int(values[1]))
-        else:
-            resolution_pair = None
-
-        self.iframe_stream_info = StreamInfo(
-            bandwidth=iframe_stream_info.get('bandwidth'),
-            video=iframe_stream_info.get('video'),
-            # Audio, subtitles, and closed captions should not exist in
-            # EXT-X-I-FRAME-STREAM-INF, so just hardcode them to None.
-            audio=None,
-            subtitles=None,
-            closed_captions=None,
-            average_bandwidth=None,
-            program_id=iframe_stream_info.get('program_id'),
-            resolution=resolution_pair,
-            codecs=iframe_stream_info.get('codecs'),
-            frame_rate=None
-        )
+        self.the_uri = uri
+        self.uri_base = uri_base_for(base_uri)
+        self.iframe_stream_info = make_iframe_stream_info(iframe_stream_info)
 
     def __str__(self):
         iframe_stream_inf = []
@@ -949,6 +1942,56 @@ StreamInfo = namedtuple(
 )
 
 
+def make_stream_info(stream_info):
+    if isinstance(stream_info, StreamInfo):
+        # Already parsed, e.g. taken from a VariantPlaylist
+        return stream_info
+    resolution = stream_info.get('resolution')
+    if resolution != None:
+        resolution = resolution.strip('"')
+        values = resolution.split('x')
+        resolution_pair = (int(values[0]), int(values[1]))
+    else:
+        resolution_pair = None
+
+    return StreamInfo(
+        bandwidth=stream_info['bandwidth'],
+        video=stream_info.get('video'),
+        audio=stream_info.get('audio'),
+        subtitles=stream_info.get('subtitles'),
+        closed_captions=stream_info.get('closed_captions'),
+        average_bandwidth=stream_info.get('average_bandwidth'),
+        program_id=stream_info.get('program_id'),
+        resolution=resolution_pair,
+        codecs=stream_info.get('codecs'),
+        frame_rate=stream_info.get('frame_rate')
+    )
+
+
+def make_iframe_stream_info(iframe_stream_info):
+    resolution = iframe_stream_info.get('resolution')
+    if resolution is not None:
+        values = resolution.split('x')
+        resolution_pair = (int(values[0]), int(values[1]))
+    else:
+        resolution_pair = None
+
+    return StreamInfo(
+        bandwidth=iframe_stream_info.get('bandwidth'),
+        video=iframe_stream_info.get('video'),
+        # Audio, subtitles, and closed captions should not exist in
+        # EXT-X-I-FRAME-STREAM-INF, so just hardcode them to None.
+        audio=None,
+        subtitles=None,
+        closed_captions=None,
+        average_bandwidth=None,
+        program_id=iframe_stream_info.get('program_id'),
+        resolution=resolution_pair,
+        codecs=iframe_stream_info.get('codecs'),
+        frame_rate=None
+    )
+
+
 class Media(BasePathMixin):
     '''
     A media object from a M3U8 playlist
@@ -977,8 +2020,8 @@ class Media(BasePathMixin):
                  name=None, default=None, autoselect=None, forced=None,
                  characteristics=None, assoc_language=None,
                  instream_id=None, base_uri=None, **extras):
-        self.base_uri = base_uri
-        self.uri = uri
+        self.uri_base = uri_base_for(base_uri)
+        self.the_uri = uri
         self.type = type
         self.group_id = group_id
         self.language = language
@@ -1016,6 +2059,9 @@ class Media(BasePathMixin):
             media_out.append('INSTREAM-ID=' + self.instream_id)
         if self.characteristics:
             media_out.append('CHARACTERISTICS=' + quoted(self.characteristics))
+        # Other attributes such as CHANNELS are kept as they were read, quotes included
+        for name, value in sorted(self.extras.items()):
+            media_out.append(denormalize_attribute(name) + '=' + str(value))
 
         return ('#EXT-X-MEDIA:' + ','.join(media_out))
 
@@ -1057,17 +2103,191 @@ class Start(object):
         return ext_x_start + ':' + ','.join(output)
 
 
-def find_key(keydata, keylist):
-    if not keydata:
-        return None
-    for key in keylist:
-        if key:
-            # Check the intersection of keys and values
-            if keydata.get('uri', None) == key.uri and \
-                    keydata.get('method', 'NONE') == key.method and \
-                    keydata.get('iv', None) == key.iv:
-                return key
-    raise KeyError("No key found for key data")
+# Tags that describe the whole playlist rather than the segment that follows them
+HEADER_TAGS = frozenset([
+    '#EXTM3U', ext_x_targetduration, ext_x_media_sequence, ext_x_discontinuity_sequence, ext_x_version,
+    ext_x_allow_cache, ext_x_playlist_type, ext_i_frames_only, ext_is_independent_segments, ext_x_map,
+    ext_x_start,
+])
+
+PlaylistDelta = namedtuple('PlaylistDelta', ['added', 'removed'])
+
+
+class LivePlaylist(object):
+    '''
+    Follows a live media playlist across refreshes. Segments already known from
+    the previous update are recognised by EXT-X-MEDIA-SEQUENCE and kept as they
+    are, only the new tail of the playlist is parsed. Known segments whose tag
+    lines changed since, such as the head gaining EXT-X-PROGRAM-DATE-TIME, are
+    parsed again.
+
+    `playlist`
+      the M3U8 holding the current window of segments, None until the first update
+    '''
+
+    def __init__(self, base_uri=None, strict=False, custom_tags_parser=None):
+        self.base_uri = base_uri
+        self.strict = strict
+        self.custom_tags_parser = custom_tags_parser
+        self.playlist = None
+        # Tag lines before each segment of the playlist, to notice them changing
+        self.segment_tags = []
+
+    def update(self, content):
+        '''
+        Applies a freshly fetched copy of the playlist. Returns a PlaylistDelta
+        with the segments appended and the ones that expired from the head.
+        '''
+        lines = string_to_lines(content)
+        header, chunks, trailing, media_sequence = split_segments(lines)
+        previous = self.playlist
+        known = self.known_segments(header, chunks, media_sequence)
+        self.segment_tags = [tags for tags, uri in chunks]
+        if known is None:
+            self.playlist = M3U8(data=parse_lines(lines, self.strict, self.custom_tags_parser),
+                                 base_uri=previous.uri_base if previous else self.base_uri)
+            removed = list(previous.segments) if previous else []
+            return PlaylistDelta(list(self.playlist.segments), removed)
+
+        segments, reparsed = known
+        expired = media_sequence - previous.media_sequence
+        tail = [line for tags, uri in chunks[len(segments):] for line in tags + [uri]] + trailing
+        initial_state = segment_state(segments[-1])
+        data = parse_lines(header + tail, self.strict, self.custom_tags_parser, initial_state)
+        key = initial_state.get('current_key')
+        if key and key_data_identity(key) not in set(key_data_identity(params)
+                                                      for params in data['keys'] if params):
+            data['keys'].insert(0, key)
+
+        playlist = M3U8(data=data, base_uri=previous.uri_base)
+        added = list(playlist.segments)
+        # Segments that share a key share the Key object, reuse the ones already known
+        keys = list(previous.keys)
+        known_keys = dict((key_identity(key), key) for key in keys if key)
+        for segment in reparsed + added:
+            if segment.key:
+                identity = key_identity(segment.key)
+                if identity in known_keys:
+                    segment.key = known_keys[identity]
+                else:
+                    known_keys[identity] = segment.key
+                    keys.append(segment.key)
+        if None in playlist.keys and None not in keys:
+            keys.append(None)
+
+        playlist.segments = SegmentList(segments + added)
+        if reparsed:
+            # Cheaper to index the window again than to find the changed entries
+            index = DateTimeIndex()
+            indexed = enumerate(playlist.segments, media_sequence)
+        else:
+            index = previous.date_time_index.since(media_sequence)
+            indexed = enumerate(added, media_sequence + len(segments))
+        for number, segment in indexed:
+            if segment.current_program_date_time:
+                index.add(segment.current_program_date_time,
+                          segment.current_program_date_time + timedelta(seconds=segment.duration), number)
+        playlist.date_time_index = index
+        used_keys = set(id(segment.key) for segment in playlist.segments)
+        playlist.keys = [key for key in keys if id(key) in used_keys]
+        playlist.files = [key.uri for key in playlist.keys if key and key.uri]
+        playlist.files.extend(playlist.segments.uri)
+        for segment in segments:
+            if segment.program_date_time:
+                playlist.program_date_time = segment.program_date_time
+                break
+
+        self.playlist = playlist
+        return PlaylistDelta(added, list(previous.segments[:expired]))
+
+    def known_segments(self, header, chunks, media_sequence):
+        '''
+        Returns the segments of the previous update still in the playlist and the
+        ones among them whose tag lines changed, parsed again. None when the playlist
+        has to be parsed in full.
+        '''
+        previous = self.playlist
+        if (previous is None or not previous.segments or previous.media_sequence is None or
+                len(self.segment_tags) != len(previous.segments)):
+            return None
+        expired = media_sequence - previous.media_sequence
+        if expired < 0 or expired >= len(previous.segments) or len(chunks) < len(previous.segments) - expired:
+            return None
+
+        segments = list(previous.segments[expired:])
+        known_tags = self.segment_tags[expired:]
+        reparsed = []
+        for position, segment in enumerate(segments):
+            tags, uri = chunks[position]
+            if tags == known_tags[position]:
+                continue
+            state = segment_state(segments[position - 1]) if position else None
+            data = parse_lines(header + tags + [uri], self.strict, self.custom_tags_parser, state)
+            reparsed_segment = M3U8(data=data, base_uri=previous.uri_base).segments[0]
+            if segment_state(reparsed_segment) != segment_state(segment):
+                # The change carries over to the segments after it
+                return None
+            segments[position] = reparsed_segment
+            reparsed.append(reparsed_segment)
+        return segments, reparsed
+
+
+def split_segments(lines):
+    '''
+    Splits the lines of a media playlist into the header tags, a (tag lines, uri)
+    pair for every segment and the lines after the last segment. Also returns the
+    media sequence.
+    '''
+    header = []
+    chunks = []
+    media_sequence = 0
+    start = 0
+    in_header = True
+    for index, line in enumerate(lines):
+        if line.startswith('#'):
+            if in_header:
+                colon = line.find(':')
+                tag = line if colon == -1 else line[:colon]
+                if tag in HEADER_TAGS:
+                    header.append(line)
+                    if tag == ext_x_media_sequence:
+                        media_sequence = int(line[colon + 1:])
+                    start = index + 1
+                    continue
+                in_header = False
+        else:
+            line = line.strip()
+            if line:
+                in_header = False
+                chunks.append((lines[start:index], line))
+                start = index + 1
+    return header, chunks, lines[start:], media_sequence
+
+
+def segment_state(segment):
+    '''
+    Returns the parser state carried over to the segments that follow `segment`
+    '''
+    state = {}
+    if segment.key:
+        state['current_key'] = dict((name, getattr(segment.key, name))
+                                    for name in ('method', 'uri', 'iv', 'keyformat', 'keyformatversions')
+                                    if getattr(segment.key, name) is not None)
+    if segment.current_program_date_time:
+        end = segment.current_program_date_time + timedelta(seconds=segment.duration)
+        state['current_program_date_time'] = end
+    if segment.scte35:
+        state['current_cue_out_scte35'] = segment.scte35
+        state['current_cue_out_duration'] = segment.scte35_duration
+    return state
+
+
+def key_identity(key):
+    return key.method, key.uri, key.iv, key.keyformat
+
+
+def key_data_identity(keydata):
+    return keydata.get('method'), keydata.get('uri'), keydata.get('iv'), keydata.get('keyformat')
 
 
 def denormalize_attribute(attribute):
@@ -1083,12 +2303,35 @@ def int_or_float_to_string(number):
 
 
 def urijoin(base_uri, path):
+    if is_url(path):
+        return path
     if is_url(base_uri):
-        return urlparse.urljoin(base_uri, path)
+        return urljoin(base_uri, path)
     else:
         return os.path.normpath(os.path.join(base_uri, path.strip('/')))
 
-PYTHON_MAJOR_VERSION = sys.version_info
+
+def resolve_uris(content, base_uri):
+    '''
+    Returns the playlist text `content` with its segment and variant uris, and the
+    URI attributes of its tags, resolved against `base_uri`. Everything else,
+    including tags the parser does not know, is kept exactly as it is.
+    '''
+    uri_base = uri_base_for(base_uri)
+
+    def resolve_attribute(match):
+        return match.group(1) + uri_base.resolve(match.group(2)) + '"'
+
+    lines = []
+    for line in string_to_lines(content):
+        line = line.strip()
+        if line.startswith('#'):
+            if 'URI="' in line:
+                line = URI_ATTRIBUTE_PATTERN.sub(resolve_attribute, line)
+        elif line:
+            line = uri_base.resolve(line)
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
 
 
 def loads(content, uri=None, custom_tags_parser=None):
@@ -1109,8 +2352,7 @@ def load(uri, timeout=None, headers={}, custom_tags_parser=None):
     '''
     Retrieves the content from a given URI and returns a M3U8 object.
     Raises ValueError if invalid content or IOError if request fails.
-    Raises socket.timeout(python 2.7+) or urllib2.URLError(python 2.6) if
-    timeout happens when loading from uri
+    Raises socket.timeout if timeout happens when loading from uri
     '''
     if is_url(uri):
         return load_from_uri(uri, timeout, headers, custom_tags_parser)
@@ -1118,21 +2360,24 @@ def load(uri, timeout=None, headers={}, custom_tags_parser=None):
         return load_from_file(uri, custom_tags_parser)
 
 
-# Support for python3 inspired by https://github.com/szemtiv/m3u8/
+def load_variants(uri, timeout=None, headers={}):
+    '''
+    Retrieves a master playlist from a given URI or file and returns only its
+    variant definitions, see `parse_variants`
+    '''
+    if is_url(uri):
+        response = transport.request(uri, headers=headers, timeout=timeout, verify=False)
+        return parse_variants(response.content, base_uri=parsed_url(response.url))
+    with open(uri) as fileobj:
+        return parse_variants(fileobj.read(), base_uri=os.path.dirname(uri))
 
 
 def load_from_uri(uri, timeout=None, headers={}, custom_tags_parser=None):
-    request = Request(uri, headers=headers)
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    resource = urlopen(request, timeout=timeout, context=ctx)
-    base_uri = parsed_url(resource.geturl())
-    if PYTHON_MAJOR_VERSION < (3,):
-        content = read_python2x(resource)
-    else:
-        content = read_python3x(resource)
-    return M3U8(content, base_uri=base_uri, custom_tags_parser=custom_tags_parser)
+    # Parsed as the body arrives, the raw playlist is never held in memory as a whole
+    with transport.stream(uri, headers=headers, timeout=timeout, verify=False) as response:
+        data = parse_lines(read_lines(response), custom_tags_parser=custom_tags_parser)
+    base_uri = parsed_url(response.url)
+    return M3U8(data=data, base_uri=base_uri)
 
 
 def parsed_url(url):
@@ -1142,18 +2387,8 @@ def parsed_url(url):
     return urljoin(prefix, base_path)
 
 
-def read_python2x(resource):
-    return resource.read().strip()
-
-
-def read_python3x(resource):
-    return resource.read().decode(
-        resource.headers.get_content_charset(failobj="utf-8")
-    )
-
-
 def load_from_file(uri, custom_tags_parser=None):
     with open(uri) as fileobj:
-        raw_content = fileobj.read().strip()
+        data = parse_lines(fileobj, custom_tags_parser=custom_tags_parser)
     base_uri = os.path.dirname(uri)
-    return M3U8(raw_content, base_uri=base_uri, custom_tags_parser=custom_tags_parser)
+    return M3U8(data=data, base_uri=base_uri)
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import constants
+import m3u8
+import transport
+import workers
+
+_pollers = {}
+_lock = threading.Lock()
+_flights = workers.SingleFlight()
+
+
+class PlaylistPoller(object):
+    '''
+    Keeps the latest copy of one live media playlist, with absolute uris so it can be
+    served from the plugin. A thread of its own refreshes it while players keep asking
+    for it, every player is served the same copy. The copy is the upstream text with
+    only its uris resolved, so cue, date range and unknown tags reach the players.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.live = m3u8.LivePlaylist()
+        self.content = None
+        self.uri_base = None
+        self.interval = constants.POLL_INTERVAL
+        self.refreshed = 0
+        self.requested = time.time()
+        self.ended = False
+        self.thread = None
+
+    def get(self):
+        '''
+        Returns the latest copy, fetching it when there is none yet
+        '''
+        content = self.content
+        if content is None:
+            content = _flights.do(self.url, self.refresh)
+        return content
+
+    def refresh(self):
+        response = transport.request(self.url, timeout=constants.POLL_TIMEOUT, verify=False)
+        base_uri = m3u8.parsed_url(response.url)
+        if not base_uri.endswith('/'):
+            base_uri = base_uri + '/'
+        if self.uri_base is None or self.uri_base.uri != base_uri:
+            self.uri_base = m3u8.UriBase(base_uri)
+        # The parsed playlist only tells whether anything changed, dumping it would
+        # drop the tags it does not model
+        delta = self.live.update(response.content)
+        playlist = self.live.playlist
+        self.content = m3u8.resolve_uris(response.content, self.uri_base)
+
+        interval = playlist.target_duration or constants.POLL_INTERVAL
+        if not (delta.added or delta.removed):
+            interval = interval / 2.0
+        self.interval = interval
+        self.ended = bool(playlist.is_endlist)
+        self.refreshed = time.time()
+        return self.content
+
+    def poll(self):
+        while True:
+            delay = self.refreshed + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            with _lock:
+                if time.time() - self.requested > constants.POLL_IDLE_TIMEOUT:
+                    self.thread = None
+                    if _pollers.get(self.url) is self:
+                        del _pollers[self.url]
+                    return
+            if self.ended:
+                # Nothing changes any more, keep serving the last copy
+                self.refreshed = time.time()
+                continue
+            try:
+                _flights.do(self.url, self.refresh)
+            except Exception as e:
+                Log("Playlist refresh failed for " + self.url + ": " + str(e))
+                self.refreshed = time.time()
+
+
+def get_playlist(url):
+    '''
+    Returns the latest copy of the live media playlist at `url`, shared by every
+    player asking for it. Concurrent first requests share one fetch.
+    '''
+    with _lock:
+        poller = _pollers.get(url)
+        if poller is None:
+            poller = _pollers[url] = PlaylistPoller(url)
+        poller.requested = time.time()
+        if poller.thread is None:
+            poller.thread = threading.Thread(target=poller.poll)
+            poller.thread.daemon = True
+            poller.thread.start()
+    return poller.get()
@@ -0,0 +1,120 @@
+import bisect
+import collections
+
+
+class VariantIndex(object):
+    '''
+    Variant playlists from any number of master playlists, ordered by bandwidth so
+    the best variant under a bandwidth cap is found by bisection. Among variants of
+    the same bandwidth the one added first wins.
+    '''
+
+    def __init__(self, manifests=()):
+        variants = [variant for manifest in manifests for variant in manifest.playlists]
+        # sorted is stable, so equal bandwidths keep the order of the manifests
+        entries = sorted(((int(variant.stream_info.bandwidth), variant) for variant in variants),
+                         key=lambda entry: entry[0])
+        self.bandwidths = [bandwidth for bandwidth, _ in entries]
+        self.variants = [variant for _, variant in entries]
+
+    def __len__(self):
+        return len(self.variants)
+
+    def add(self, variant):
+        bandwidth = int(variant.stream_info.bandwidth)
+        position = bisect.bisect_right(self.bandwidths, bandwidth)
+        self.bandwidths.insert(position, bandwidth)
+        self.variants.insert(position, variant)
+
+    def group_by(self, key):
+        '''
+        Splits the index into an OrderedDict of one VariantIndex per distinct `key(variant)`
+        '''
+        groups = collections.OrderedDict()
+        for variant in self.variants:
+            groups.setdefault(key(variant), VariantIndex()).add(variant)
+        return groups
+
+    def select(self, max_bandwidth=None, max_resolution=None, codecs=None, max_frame_rate=None):
+        '''
+        Returns the highest bandwidth variant within `max_bandwidth` that also meets
+        the other constraints, see `accepts`. When none fits under the cap the lowest
+        bandwidth variant meeting the constraints is returned instead, None when no
+        variant meets them at all.
+        '''
+        end = len(self.variants)
+        if max_bandwidth is not None:
+            end = bisect.bisect_right(self.bandwidths, max_bandwidth)
+
+        for position in xrange(end - 1, -1, -1):
+            if accepts(self.variants[position], max_resolution, codecs, max_frame_rate):
+                # Prefer the first added of the variants with this bandwidth
+                first = bisect.bisect_left(self.bandwidths, self.bandwidths[position])
+                for candidate in self.variants[first:position]:
+                    if accepts(candidate, max_resolution, codecs, max_frame_rate):
+                        return candidate
+                return self.variants[position]
+
+        for variant in self.variants[end:]:
+            if accepts(variant, max_resolution, codecs, max_frame_rate):
+                return variant
+        return None
+
+    def within(self, max_bandwidth=None, max_resolution=None, codecs=None, max_frame_rate=None):
+        '''
+        Returns every variant within `max_bandwidth` that meets the other constraints,
+        lowest bandwidth first
+        '''
+        end = len(self.variants)
+        if max_bandwidth is not None:
+            end = bisect.bisect_right(self.bandwidths, max_bandwidth)
+        return [variant for variant in self.variants[:end]
+                if accepts(variant, max_resolution, codecs, max_frame_rate)]
+
+
+def accepts(variant, max_resolution=None, codecs=None, max_frame_rate=None):
+    '''
+    Whether a variant meets the constraints, attributes the variant doesn't
+    declare are not held against it
+
+    `max_resolution`
+      (width, height) neither dimension may exceed
+
+    `codecs`
+      codec prefixes, e.g. ('avc1', 'mp4a'), every codec of the variant must start with one
+
+    `max_frame_rate`
+      highest frame rate allowed
+    '''
+    info = variant.stream_info
+    if max_resolution and info.resolution:
+        if info.resolution[0] > max_resolution[0] or info.resolution[1] > max_resolution[1]:
+            return False
+    if codecs and info.codecs:
+        for codec in info.codecs.split(','):
+            if not codec.strip().startswith(codecs):
+                return False
+    if max_frame_rate and info.frame_rate:
+        if info.frame_rate > max_frame_rate:
+            return False
+    return True
+
+
+def parse_resolution(text):
+    '''
+    Parses a resolution such as "1280x720" into a (width, height) tuple, None when
+    `text` is empty or invalid
+    '''
+    try:
+        width, height = text.lower().split('x')
+        return int(width), int(height)
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_codecs(text):
+    '''
+    Parses a comma separated list of codec prefixes into a tuple, None when empty
+    '''
+    codecs = tuple(codec.strip() for codec in (text or '').split(',') if codec.strip())
+    return codecs or None
@@ -0,0 +1,108 @@
+import threading
+import time
+from urlparse import urlparse
+
+import constants
+import m3u8
+import transport
+
+_lock = threading.Lock()
+
+
+def host_of(url):
+    return urlparse(url).netloc
+
+
+def estimate(host):
+    '''
+    Returns the throughput estimate for a CDN host in bits per second, None when
+    the host has no estimate younger than THROUGHPUT_MAX_AGE
+    '''
+    entry = (Dict[constants.THROUGHPUT_KEY] or {}).get(host)
+    if entry is None or time.time() - entry['updated'] > constants.THROUGHPUT_MAX_AGE:
+        return None
+    return entry['estimate']
+
+
+def record(host, bits_per_second):
+    '''
+    Folds a throughput sample into the exponentially weighted estimate for a host,
+    kept in Dict so later plays reuse it, and returns the new estimate
+    '''
+    with _lock:
+        now = time.time()
+        previous = estimate(host)
+        if previous is not None:
+            bits_per_second = (constants.THROUGHPUT_WEIGHT * bits_per_second +
+                               (1 - constants.THROUGHPUT_WEIGHT) * previous)
+        # Assign a fresh dict so Dict notices the change, dropping hosts gone stale
+        estimates = dict((name, entry) for name, entry in (Dict[constants.THROUGHPUT_KEY] or {}).items()
+                         if now - entry['updated'] <= constants.THROUGHPUT_MAX_AGE)
+        estimates[host] = {'estimate': bits_per_second, 'updated': now}
+        Dict[constants.THROUGHPUT_KEY] = estimates
+        Dict.Save()
+    return bits_per_second
+
+
+def probe(host, urls, deadline):
+    '''
+    Times downloads of the first segments of the variant playlists at `urls` until
+    `deadline`, recording every measurement as a sample for `host`. Returns the
+    resulting estimate, None when nothing could be downloaded
+    '''
+    bandwidth = None
+    for url in urls:
+        if time.time() >= deadline:
+            break
+        try:
+            sample = measure(url, deadline)
+        except Exception as e:
+            Log("Throughput probe failed for " + url + ": " + str(e))
+            continue
+        if sample:
+            bandwidth = record(host, sample)
+    return bandwidth
+
+
+def measure(url, deadline):
+    '''
+    Returns the bits per second achieved downloading the first PROBE_SEGMENTS segments
+    of the variant playlist at `url`, reading at most PROBE_MAX_BYTES until `deadline`
+    '''
+    # Only the first segments are needed, stop reading the playlist once they are in
+    segment_uris = []
+    with transport.stream(url, timeout=constants.PROBE_TIMEOUT, verify=False) as response:
+        base_uri = m3u8.parsed_url(response.url)
+        if not base_uri.endswith('/'):
+            base_uri = base_uri + '/'
+        for item in m3u8.iterparse(response, base_uri=base_uri):
+            if item[0] == 'segment':
+                segment_uris.append(item[1].absolute_uri)
+                if len(segment_uris) == constants.PROBE_SEGMENTS:
+                    break
+
+    start = time.time()
+    received = 0
+    for segment_uri in segment_uris:
+        received += download(segment_uri, deadline, constants.PROBE_MAX_BYTES - received)
+        if received >= constants.PROBE_MAX_BYTES or time.time() >= deadline:
+            break
+    elapsed = time.time() - start
+    if not received or elapsed <= 0:
+        return None
+    return received * 8 / elapsed
+
+
+def download(url, deadline, max_bytes):
+    '''
+    Reads a url until its end, `max_bytes` or `deadline`, whichever comes first,
+    and returns the number of bytes read
+    '''
+    received = 0
+    with transport.stream(url, timeout=constants.PROBE_TIMEOUT, verify=False) as response:
+        while received < max_bytes and time.time() < deadline:
+            chunk = response.read(transport.READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+    return received
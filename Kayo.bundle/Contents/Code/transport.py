@@ -0,0 +1,220 @@
+import httplib
+import socket
+import ssl
+import threading
+import time
+import zlib
+from urlparse import urlparse, urljoin
+
+DEFAULT_TIMEOUT = 30
+MAX_IDLE_PER_HOST = 4
+# Servers usually drop idle keep-alive connections after about a minute,
+# don't bother handing out connections older than this
+IDLE_TIMEOUT = 50
+MAX_REDIRECTS = 5
+READ_CHUNK_SIZE = 16 * 1024
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+_contexts = {}
+_pool = {}
+_lock = threading.Lock()
+
+
+class HTTPError(IOError):
+
+    def __init__(self, url, status, content):
+        IOError.__init__(self, 'HTTP %d for %s' % (status, url))
+        self.url = url
+        self.status = status
+        self.content = content
+
+
+class Response(object):
+    '''
+    A fully read HTTP response
+
+    `url`
+      the final url after following redirects
+
+    `status`
+      the HTTP status code
+
+    `headers`
+      a dict with the lower-cased response headers
+
+    `content`
+      the decoded response body
+    '''
+
+    def __init__(self, url, status, headers, content):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+
+class StreamingResponse(object):
+    '''
+    A response whose body is read on demand with `read`, with the same `url`, `status`
+    and `headers` as Response. The connection goes back to the pool once the body has
+    been read to the end, `close` drops it before that.
+    '''
+
+    def __init__(self, url, key, conn, response):
+        self.url = url
+        self.status = response.status
+        self.headers = dict((name.lower(), value) for name, value in response.getheaders())
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._decoder = None
+        if self.headers.get('content-encoding') == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, amt=None):
+        if amt is None:
+            return ''.join(iter(lambda: self.read(READ_CHUNK_SIZE), ''))
+        while self._response is not None:
+            try:
+                chunk = self._response.read(amt)
+            except:
+                self.close()
+                raise
+            if not chunk:
+                self._finish()
+                return self._decoder.flush() if self._decoder else ''
+            if self._decoder:
+                chunk = self._decoder.decompress(chunk)
+            if chunk:
+                return chunk
+        return ''
+
+    def close(self):
+        if self._response is not None:
+            self._response = None
+            self._conn.close()
+
+    def _finish(self):
+        if self._response.will_close:
+            self._conn.close()
+        else:
+            _release(self._key, self._conn)
+        self._response = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def ssl_context(verify=True):
+    '''
+    Returns the shared SSL context for the given verification mode, it is only
+    built once so every connection shares the same certificate store and settings
+    '''
+    with _lock:
+        ctx = _contexts.get(verify)
+        if ctx is None:
+            ctx = ssl.create_default_context()
+            if not verify:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            _contexts[verify] = ctx
+        return ctx
+
+
+def request(url, data=None, headers=None, method=None, timeout=None, verify=True):
+    '''
+    Performs a request over a pooled keep-alive connection and returns a Response.
+    Requests with a body are sent as POST unless `method` says otherwise.
+    Raises HTTPError for 4xx/5xx responses.
+    '''
+    response = stream(url, data, headers, method, timeout, verify)
+    return Response(response.url, response.status, response.headers, response.read())
+
+
+def stream(url, data=None, headers=None, method=None, timeout=None, verify=True):
+    '''
+    Like `request` but returns a StreamingResponse as soon as the headers are in,
+    the body is then read on demand
+    '''
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    if method is None:
+        method = 'GET' if data is None else 'POST'
+    headers = dict(headers or {})
+    headers.setdefault('Accept-Encoding', 'gzip')
+
+    for _ in range(MAX_REDIRECTS + 1):
+        response = _open(url, method, data, headers, timeout, verify)
+        location = response.headers.get('location')
+        if response.status in REDIRECT_CODES and location:
+            response.read()
+            url = urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                method = 'GET'
+                data = None
+            continue
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.read())
+        return response
+
+    raise HTTPError(url, response.status, response.read())
+
+
+def _open(url, method, data, headers, timeout, verify):
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc, verify)
+    path = parsed.path or '/'
+    if parsed.query:
+        path = path + '?' + parsed.query
+
+    conn, reused = _acquire(key, timeout)
+    try:
+        conn.request(method, path, data, headers)
+        response = conn.getresponse()
+    except (httplib.HTTPException, socket.error):
+        conn.close()
+        if not reused:
+            raise
+        # The server closed an idle connection under us, retry once on a fresh one
+        conn, _ = _acquire(key, timeout, fresh=True)
+        try:
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+        except:
+            conn.close()
+            raise
+    return StreamingResponse(url, key, conn, response)
+
+
+def _acquire(key, timeout, fresh=False):
+    if not fresh:
+        now = time.time()
+        with _lock:
+            idle = _pool.get(key, [])
+            while idle:
+                conn, released = idle.pop()
+                if now - released < IDLE_TIMEOUT:
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+
+    scheme, netloc, verify = key
+    if scheme == 'https':
+        conn = httplib.HTTPSConnection(netloc, timeout=timeout, context=ssl_context(verify))
+    else:
+        conn = httplib.HTTPConnection(netloc, timeout=timeout)
+    return conn, False
+
+
+def _release(key, conn):
+    if conn.sock is None:
+        return
+    with _lock:
+        idle = _pool.setdefault(key, [])
+        if len(idle) < MAX_IDLE_PER_HOST:
+            idle.append((conn, time.time()))
+            return
+    conn.close()
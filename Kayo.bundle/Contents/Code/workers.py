@@ -0,0 +1,133 @@
+import Queue
+import threading
+import time
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Task(object):
+    '''
+    A call submitted to a Pool, `result` blocks until it has run
+    '''
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        '''
+        Returns the value of the call, re-raising its exception if it failed.
+        Raises TimeoutError if it hasn't finished within `timeout` seconds
+        '''
+        if not self.wait(timeout):
+            raise TimeoutError('Task did not finish in time')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Pool(object):
+    '''
+    A fixed number of daemon worker threads, started on the first submit
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        task = Task(func, args, kwargs)
+        self._queue.put(task)
+        self._start_workers()
+        return task
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            self._queue.get().run()
+
+
+def wait_all(tasks, timeout):
+    '''
+    Waits until every task has finished or `timeout` seconds have passed,
+    returns the tasks that finished
+    '''
+    deadline = time.time() + timeout
+    for task in tasks:
+        task.wait(max(0, deadline - time.time()))
+    return [task for task in tasks if task.done()]
+
+
+class RateLimiter(object):
+    '''
+    Spaces calls to `acquire` at least 1 / `rate` seconds apart across all threads,
+    blocking the caller until its turn comes
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SingleFlight(object):
+    '''
+    Runs a call once for all the threads asking for the same key at the same time,
+    they all get its result or its exception
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            task = self._calls.get(key)
+            leader = task is None
+            if leader:
+                task = Task(func, args, kwargs)
+                self._calls[key] = task
+        if leader:
+            try:
+                task.run()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+        return task.result()